@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from pathlib import Path
+from deserialize_network import load_cached_network
+from datasets import SyntheticDataset, decode_timeseries, deserialize_np, encode_timeseries, serialize_np
+from synda_db import COLUMNS, ResultSink
+import synda_db
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import scipy
+import continuous_sim as continuous
+import discrete_sim as discrete
+import meanfield_sim as meanfield
+import generate_graphs
+
+
+GROUPS = ['simulation', 'setup', 'serialize', 'dataset']
+
+MODELS = {'CONTINUOUS': continuous, 'DISCRETE': discrete, 'MEANFIELD': meanfield}
+
+# *_setup functions of generate_graphs by graph type, called as (n, k, rng)
+SETUPS = {
+    'ER': lambda n, k, rng: generate_graphs.er_setup(n, k, rng),
+    'WS': lambda n, k, rng: generate_graphs.ws_setup(n, k, 0.2, rng),
+    'BA': lambda n, k, rng: generate_graphs.ba_setup(n, k, rng),
+    'GN': lambda n, k, rng: generate_graphs.gn_setup(n, k, rng),
+    'CG': lambda n, k, rng: generate_graphs.cg_setup(n),
+}
+
+
+"""
+Returns the lines of a params/ file (e.g. params/N).
+"""
+
+
+def read_params(params_dir, name):
+    with open(Path(params_dir) / name) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+"""
+Returns fixed, mid-range model parameters for a benchmark run on a network with mean degree k
+(R0 = 1.2, 401 continuous samples or 500 discrete steps), so runs are comparable across commits.
+"""
+
+
+def benchmark_parameters(module, graph, k):
+    mp = module.ModelParameters()
+    mp.population = len(graph)
+    mp.initial_infected = 4
+    mp.infectiousness = 0.1
+
+    if module is not discrete:
+        r0 = 1.2
+        mp.i_out = mp.infectiousness * ((k - r0) / r0)
+        mp.i_rec_prop = 0.94
+        mp.sample_time = 1/10
+        mp.time = 40
+    else:
+        mp.i_d = 0.01
+        mp.i_r = 0.1
+        mp.delta = 1
+        mp.maxtime = 500
+
+    return mp
+
+
+"""
+Returns the number of compartment transitions (infections, recoveries and deaths) of a run from
+its last sample.
+"""
+
+
+def transitions(module, mp, last):
+    if module is not discrete:
+        # sub, c_inf, rec, dead
+        return last[1] - mp.initial_infected + last[2] + last[3]
+    # sub, inf, dead, rec
+    return mp.population - mp.initial_infected - last[0] + last[2] + last[3]
+
+
+"""
+Runs `repeat` simulations of a model on a network file.
+"""
+
+
+def bench_simulation(model, path, k, repeat, seed):
+    module = MODELS[model]
+    graph = load_cached_network(path)
+    rng = np.random.default_rng(seed)
+
+    events = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        mp = benchmark_parameters(module, graph, k)
+        samples = module.run_model(mp, graph, rng)
+        graph.reset()
+        events += transitions(module, mp, samples[-1])
+    seconds = time.perf_counter() - start
+
+    return {
+        'seconds': seconds,
+        'runs': repeat,
+        'events': int(events),
+        'runs_per_s': repeat / seconds,
+        'events_per_s': events / seconds,
+    }
+
+
+"""
+Builds a graph with one of the generate_graphs *_setup functions, best of `repeat` builds.
+"""
+
+
+def bench_setup(graph_type, n, k, repeat, seed):
+    rng = np.random.default_rng(seed)
+    seconds = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        adj_list = SETUPS[graph_type](n, k, rng)
+        seconds = min(seconds, time.perf_counter() - start)
+
+    edges = sum(len(a) for a in adj_list)
+    return {
+        'seconds': seconds,
+        'edges': edges,
+        'edges_per_s': edges / seconds,
+    }
+
+
+"""
+Round-trips `count` (incidences, 5) timeseries through serialize_np/deserialize_np and through the
+raw encoding the database uses (encode_timeseries/decode_timeseries).
+"""
+
+
+def bench_serialize(count, incidences, seed):
+    rng = np.random.default_rng(seed)
+    arrays = [rng.random((incidences, 5)) for _ in range(count)]
+    size = sum(a.nbytes for a in arrays)
+
+    metrics = {}
+    for name, encode, decode in (
+            ('serialize_np', serialize_np, deserialize_np),
+            ('encode_timeseries', encode_timeseries, lambda b: decode_timeseries(b, (incidences, 5)))):
+        start = time.perf_counter()
+        blobs = [encode(a) for a in arrays]
+        encoded = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for b in blobs:
+            decode(b)
+        decoded = time.perf_counter() - start
+
+        metrics[name] = {
+            'encode_s': encoded,
+            'decode_s': decoded,
+            'encode_mb_per_s': size / 1e6 / encoded,
+            'decode_mb_per_s': size / 1e6 / decoded,
+            'bytes_per_array': sum(len(b) for b in blobs) / count,
+        }
+    return metrics
+
+
+"""
+Writes a table of `rows` random cases, exports it, and times loading it with SyntheticDataset
+(from the export and straight from the database, whole and chunked) and splitting it.
+"""
+
+
+def bench_dataset(rows, incidences, seed):
+    rng = np.random.default_rng(seed)
+    metrics = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database_name = os.path.join(tmp, 'synda.db')
+        csv = os.path.join(tmp, 'synthetic-dataset.csv.gz')
+
+        table = pd.DataFrame({
+            'case': ['BA-8-{}'.format(i) for i in range(rows)],
+            'population': 1000,
+            'backend': 'CONTINUOUS',
+            'initial_infected': rng.choice([2, 4, 7, 10], rows),
+            'network': 'BA',
+            'k': 8,
+            'infectiousness': rng.uniform(0.01, 0.25, rows),
+            'i_out': rng.uniform(0.01, 0.25, rows),
+            'i_rec_prop': rng.uniform(0.9, 1, rows),
+            'timeseries': [encode_timeseries(rng.random((incidences, 5))) for _ in range(rows)],
+        })[COLUMNS]
+
+        start = time.perf_counter()
+        with ResultSink(database_name, 'bench', (incidences, 5)) as sink:
+            sink.write(table)
+        metrics['write_s'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        files = synda_db.export(database_name, 'bench', csv)
+        metrics['export_s'] = time.perf_counter() - start
+        metrics['export_mb'] = sum(size for _, size in files) / 2**20
+
+        for name, load in (('load_csv_s', lambda: SyntheticDataset(csv)),
+                           ('load_csv_chunked_s', lambda: SyntheticDataset(csv, chunked=True)),
+                           ('load_database_s', lambda: SyntheticDataset.from_database(database_name, 'bench'))):
+            start = time.perf_counter()
+            dataset = load()
+            metrics[name] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        dataset.split([0.7, 0.3], seed=seed)
+        metrics['split_s'] = time.perf_counter() - start
+
+    metrics['rows_per_s'] = rows / metrics['load_csv_s']
+    return metrics
+
+
+"""
+Runs a benchmark case in a forked process, so every case starts from the same state and reports its
+own peak resident set size. Returns (metrics, peak RSS in MB, RSS in MB when the case started).
+"""
+
+
+def isolated(case, *args):
+    def child(conn):
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        try:
+            metrics = case(*args)
+        except Exception as e:
+            metrics = {'error': repr(e)}
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        scale = 1 / 1024 ** 2 if sys.platform == 'darwin' else 1 / 1024
+        conn.send((metrics, peak * scale, baseline * scale))
+        conn.close()
+
+    ctx = multiprocessing.get_context('fork')
+    receive, send = ctx.Pipe(duplex=False)
+    p = ctx.Process(target=child, args=(send,))
+    p.start()
+    send.close()
+    result = receive.recv()
+    p.join()
+    return result
+
+
+"""
+Returns the benchmark cases selected by args as (name, group, params, case, case args) tuples.
+"""
+
+
+def cases(args):
+    sizes = args.sizes or [int(n) for n in read_params(args.params_dir, 'N')]
+    graph_types = args.graph_types or read_params(args.params_dir, 'GRAPH')
+
+    if 'simulation' in args.groups:
+        for model in args.models:
+            for graph_type in graph_types:
+                for n in sizes:
+                    name = '{}-{}-{:04d}'.format(graph_type, args.k, n)
+                    path = Path(args.network_dir) / name
+                    if not path.exists() and not Path(str(path) + '.csr').exists():
+                        print('skipping {}: no such network'.format(path), file=sys.stderr)
+                        continue
+                    yield ('simulation/{}/{}'.format(model, name), 'simulation',
+                           {'model': model, 'graph': graph_type, 'k': args.k, 'n': n},
+                           bench_simulation, (model, str(path), args.k, args.repeat, args.seed))
+
+    if 'setup' in args.groups:
+        for graph_type in graph_types + ['CG']:
+            for n in sizes:
+                yield ('setup/{}/{}'.format(graph_type, n), 'setup',
+                       {'graph': graph_type, 'k': args.k, 'n': n},
+                       bench_setup, (graph_type, n, args.k, 1, args.seed))
+
+    if 'serialize' in args.groups:
+        yield ('serialize', 'serialize', {'count': args.rows, 'incidences': args.incidences},
+               bench_serialize, (args.rows, args.incidences, args.seed))
+
+    if 'dataset' in args.groups:
+        yield ('dataset', 'dataset', {'rows': args.rows, 'incidences': args.incidences},
+               bench_dataset, (args.rows, args.incidences, args.seed))
+
+
+"""
+Returns the exponent b of seconds ~ n^b fitted over the sizes of every simulated model and graph type
+and every graph setup.
+"""
+
+
+def scaling(results):
+    curves = {}
+    for r in results:
+        if r['group'] in ('simulation', 'setup') and 'seconds' in r['metrics']:
+            key = '/'.join(r['name'].split('/')[:2])
+            if r['group'] == 'simulation':
+                key += '/' + r['params']['graph']
+            curves.setdefault(key, []).append((r['params']['n'], r['metrics']['seconds']))
+
+    exponents = {}
+    for key, points in curves.items():
+        if len(points) > 1:
+            n, seconds = np.log(np.array(points)).T
+            exponents[key] = {'sizes': [int(p[0]) for p in points],
+                              'seconds': [p[1] for p in points],
+                              'exponent': float(np.polyfit(n, seconds, 1)[0])}
+    return exponents
+
+
+"""
+Returns the commit, library versions and machine the benchmark ran on.
+"""
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+
+"""
+Returns the main number of a result: seconds for simulations and setups, otherwise the sum of all
+timings in it.
+"""
+
+
+def headline(metrics):
+    if 'seconds' in metrics:
+        return metrics['seconds']
+    return sum(v for k, v in metrics.items() if k.endswith('_s') and not k.endswith('_per_s')) or \
+        sum(headline(v) for v in metrics.values() if isinstance(v, dict))
+
+
+"""
+Prints every result next to the same case of an earlier results file.
+"""
+
+
+def compare(results, baseline):
+    before = {r['name']: r for r in baseline['results']}
+    print('{:<40} {:>10} {:>10} {:>8}'.format('case', 'before', 'after', 'speedup'))
+    for r in results:
+        if r['name'] in before and 'error' not in r['metrics'] and 'error' not in before[r['name']]['metrics']:
+            old, new = headline(before[r['name']]['metrics']), headline(r['metrics'])
+            print('{:<40} {:>9.3f}s {:>9.3f}s {:>7.2f}x'.format(r['name'], old, new, old / new))
+
+
+"""
+Runs if this file is ran as a script (rather than a module).
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the simulators, graph generators and dataset pipeline')
+
+    parser.add_argument('--groups', nargs='+', choices=GROUPS, default=GROUPS)
+    parser.add_argument('--models', nargs='+', choices=list(MODELS), default=list(MODELS))
+    parser.add_argument('--network-dir', '-W', type=str, default='networks/')
+    parser.add_argument('--params-dir', type=str, default='params/')
+    parser.add_argument('--graph-types', nargs='+', default=None, help='default: params/GRAPH')
+    parser.add_argument('--sizes', nargs='+', type=int, default=None, help='default: params/N')
+    parser.add_argument('--k', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=20, help='simulations per network')
+    parser.add_argument('--rows', type=int, default=10000, help='cases in the serialize and dataset benchmarks')
+    parser.add_argument('--incidences', type=int, default=401)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', '-o', type=str, default=None,
+                        help='results JSON (default: benchmarks/COMMIT.json)')
+    parser.add_argument('--compare', type=str, default=None, help='earlier results JSON to compare against')
+
+    args = parser.parse_args()
+
+    results = []
+    for name, group, params, case, case_args in cases(args):
+        metrics, peak, baseline = isolated(case, *case_args)
+        results.append({'name': name, 'group': group, 'params': params, 'metrics': metrics,
+                        'peak_rss_mb': peak, 'start_rss_mb': baseline})
+
+        if 'error' in metrics:
+            print('{:<40} failed: {}'.format(name, metrics['error']), file=sys.stderr)
+        else:
+            rate = ', '.join('{} {:.4g}'.format(k, v) for k, v in metrics.items()
+                             if k.endswith('_per_s'))
+            print('{:<40} {:>9.3f}s  peak {:>7.1f} MB  {}'.format(name, headline(metrics), peak, rate),
+                  file=sys.stderr)
+
+    report = {'environment': environment(), 'results': results, 'scaling': scaling(results)}
+    for key, curve in report['scaling'].items():
+        print('{:<40} seconds ~ n^{:.2f}'.format(key, curve['exponent']), file=sys.stderr)
+
+    output = args.output or os.path.join('benchmarks', '{}.json'.format(report['environment']['commit'] or 'results'))
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
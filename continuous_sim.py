@@ -1,12 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import random
-import queue
+import heapq
+import time
 import numpy as np
-import copy
 from enum import Enum
 import matplotlib.pyplot as plt
+from network import Network, RandomBuffer, Replicas
 
 T_COLUMNS = ['susceptible', 'c_infected', 'recovered', 'dead']
 P_COLUMNS = ['population', 'backend', 'initial_infected', 'network_name', 'infectiousness', 'i_out', 'i_rec_prop']
@@ -33,123 +33,339 @@ class ModelParameters:
     # determines the sample rate of the simulation, time_series information should only be captured every delta steps of the simulation
     delta: int
 
-class State_Info():
-    def __init__(self, inf_rate, state):
-        self.inf_rate = inf_rate
-        self.state = state
-    def __lt__(self, other):
-        selfPriority = (self.inf_rate, self.state)
-        otherPriority = (other.inf_rate, other.state)
-        return selfPriority < otherPriority
-
-def generate_time(state_list, start_time, num, eventid):
-
-    if state_list[0].inf_rate == -1:
-        return 99999999999999999999999, state_list[0].state
-
-    smallest_time = -1
-    smallest_state = state_list[0].state
-    for a in state_list:
-        fire_time=(-np.log(random.random()) / a.inf_rate)
-        if smallest_time == -1:
-            smallest_time = fire_time
-            smallest_state = a.state
-        elif fire_time < smallest_time:
-            smallest_time = fire_time
-            smallest_state = a.state
-    return smallest_time+start_time, smallest_state, num, eventid
-
-def next_event(node, start_time, mp):
-    node.eventID = node.eventID+1
-    state_list = []
-    if node.comp == 0:
-        if node.num_neighbors(1) == 0:
-            return 99999999999999999999999, 0
-        inf_rate = mp.infectiousness * node.num_neighbors(1)
-        state_list.append(State_Info(inf_rate, 1))
-    elif node.comp == 1:
-        state_list.append(State_Info(mp.i_out * (mp.i_rec_prop), 2))
-        state_list.append(State_Info(mp.i_out * (1 - mp.i_rec_prop), 3))
-    else:
-        state_list.append(State_Info(-1, node.comp))
-
-    return generate_time(state_list, start_time, node.num, node.eventID)
-
-def set_initial_infected(nodes, inf):
+class EventSampler:
+    """
+    Draws the next transition of a node. A susceptible node with k infected
+    neighbors gets infected at rate infectiousness * k; an infected node
+    leaves at the total rate i_out and, competing exponentials being an
+    exponential of the summed rate plus a pick in proportion to the rates,
+    recovers with probability i_rec_prop and dies otherwise. Exponential and
+    uniform draws come from buffers refilled in blocks.
+    """
+
+    def __init__(self, mp: ModelParameters, rng: np.random.Generator):
+        self.infection_rate = mp.infectiousness
+        self.leave_rate = mp.i_out
+        self.rec_prop = mp.i_rec_prop
+        self.exponential = RandomBuffer(rng.standard_exponential)
+        self.uniform = RandomBuffer(rng.random)
+
+    # (fire time, next compartment) of a susceptible node, None if it has no
+    # infected neighbor
+    def infection(self, num_infected, start_time):
+        if num_infected == 0 or self.infection_rate <= 0:
+            return None
+        return start_time + self.exponential() / (self.infection_rate * num_infected), 1
+
+    # (fire time, next compartment) of an infected node
+    def leave(self, start_time):
+        if self.leave_rate <= 0:
+            return None
+        return start_time + self.exponential() / self.leave_rate, 2 if self.uniform() < self.rec_prop else 3
+
+    # Returns (fire time, next compartment) of the next transition of a node
+    # in compartment `comp`, or None if the node cannot leave it.
+    def next_event(self, comp, num_infected, start_time):
+        if comp == 0:
+            return self.infection(num_infected, start_time)
+        if comp == 1:
+            return self.leave(start_time)
+        return None
+
+class EventQueue:
+    """
+    Binary heap of (time, node, event_id) entries holding at most one live
+    event per node. Rescheduling or cancelling a node bumps its event id,
+    which turns the entry already in the heap into a stale one that pop()
+    discards lazily; the heap is rebuilt once stale entries dominate it.
+    Given the compartment list comp, stale entries of susceptible nodes are
+    kept and popped too, as (time, node, -1), for run_model to draw the
+    node's infection time again. stale counts the stale entries popped or
+    dropped and high_water the largest the heap has been.
+    """
+
+    def __init__(self, n, comp=None):
+        self.heap = []
+        self.event_ids = [0] * n
+        # compartment the node moves to when its live event fires, -1 if none
+        self.states = [-1] * n
+        self.comp = comp
+        self.live = 0
+        self.stale = 0
+        self.high_water = 0
+        self.compact_at = 1024
+
+    def __len__(self):
+        return self.live
+
+    def schedule(self, node, event):
+        self.cancel(node)
+        if event is None:
+            return
+        self.event_ids[node] += 1
+        self.states[node] = event[1]
+        self.live += 1
+        heapq.heappush(self.heap, (event[0], node, self.event_ids[node]))
+        size = len(self.heap)
+        if size > self.high_water:
+            self.high_water = size
+        if size > self.compact_at:
+            self.compact()
+
+    def cancel(self, node):
+        if self.states[node] != -1:
+            self.event_ids[node] += 1
+            self.states[node] = -1
+            self.live -= 1
+
+    def pop(self):
+        heap, event_ids, comp = self.heap, self.event_ids, self.comp
+        while heap:
+            time, node, event_id = heapq.heappop(heap)
+            if event_ids[node] == event_id:
+                state = self.states[node]
+                self.states[node] = -1
+                self.live -= 1
+                return time, node, state
+            self.stale += 1
+            if comp is not None and comp[node] == 0:
+                return time, node, -1
+        return None
+
+    def compact(self):
+        event_ids, comp = self.event_ids, self.comp
+        size = len(self.heap)
+        self.heap = [e for e in self.heap if event_ids[e[1]] == e[2] or (comp is not None and comp[e[1]] == 0)]
+        self.stale += size - len(self.heap)
+        heapq.heapify(self.heap)
+        self.compact_at = 2 * len(self.heap) + 1024
+
+    # Removes every live event and returns them as (times, nodes, states) arrays.
+    def drain(self):
+        event_ids = self.event_ids
+        self.heap = [e for e in self.heap if event_ids[e[1]] == e[2]]
+        times = np.array([e[0] for e in self.heap], dtype=np.float64)
+        nodes = np.array([e[1] for e in self.heap], dtype=np.int64)
+        states = np.array(self.states, dtype=np.int64)[nodes]
+        for node in nodes.tolist():
+            self.cancel(node)
+        self.heap = []
+        return times, nodes, states
+
+def set_initial_infected(graph: Network, inf, rng: np.random.Generator):
     while (inf > 0):
-        i = random.randint(0, len(nodes) - 1)
-        if (nodes[i].comp == 0):
-            nodes[i].set_comp(1)
+        i = int(rng.integers(len(graph)))
+        if (graph.comp[i] == 0):
+            graph.set_comp(i, 1)
             inf -= 1
 
-def run_model(mp: ModelParameters, nodes):
-    set_initial_infected(nodes, mp.initial_infected)
-    res = []
-    c_inf_res = []
-    results = [mp.population-mp.initial_infected,mp.initial_infected,0,0]
-    c_inf_results = [mp.population-mp.initial_infected,mp.initial_infected,0,0]
-    res.append(results)
-    c_inf_res.append(c_inf_results)
-
-    q=queue.PriorityQueue()
-    markers=0
-    for a in range(int(mp.time/mp.sample_time)):
-        q.put((mp.sample_time*a,-1,-1))
-    q.put((mp.time,-1,-1))
+# Returns the (len(ticks) + 1, 4) counts of [susceptible, cumulative infected,
+# recovered, dead] at time 0 and at every sample tick (sample_time, 2 *
+# sample_time, ..., time). Once the run is absorbed the remaining rows are
+# filled without simulating event by event: with no infected node left they
+# repeat the last counts, and with no susceptible node left with an infection
+# pending only the exits of the infected nodes, already drawn, are left to
+# count. A susceptible node's infection time is drawn from its number of
+# infected neighbors whenever a neighbor gets infected, and again whenever a
+# time drawn for it before comes up, but not when infected neighbors leave.
+# rng is the numpy Generator every random draw of the run comes from, a
+# fresh unseeded one if not given. If stats is a dict, the counters of the run
+# are stored in it: events processed, stale events discarded, queue high-water
+# mark, neighbors scanned, and seconds spent in setup, the event loop and the
+# absorbed tail.
+def run_model(mp: ModelParameters, graph: Network, rng: np.random.Generator = None, stats: dict = None):
+    start = time.perf_counter()
+    rng = np.random.default_rng() if rng is None else rng
+    events = EventSampler(mp, rng)
+    set_initial_infected(graph, mp.initial_infected, rng)
+
+    # sampling ticks, the last one is always at mp.time
+    ticks = [mp.sample_time * a for a in range(1, int(mp.time/mp.sample_time))]
+    ticks.append(mp.time)
+    tick = 0
+
+    # sub, c_inf, rec, dead at time 0 and at every tick
+    samples = np.zeros((len(ticks) + 1, 4))
+    c_inf = [mp.population-mp.initial_infected,mp.initial_infected,0,0]
+    infected = mp.initial_infected
+    samples[0] = c_inf
+    row = 1
 
     #SETUP
-    counter=0
-    for node in nodes:
-        node.set_num(counter)
-        e=next_event(node, 0, mp)
-        counter+=1
-        q.put(e)
-
-    global_time=0
-    prev=copy.deepcopy(res[len(res)-1])
-    c_inf_prev=copy.deepcopy(res[len(res)-1])
-
-    while (global_time <= mp.time) and prev[1] != 0:
-        current_event = q.get()
-        global_time = current_event[0]
-        if global_time > mp.time:
+    comp = graph.comp.tolist()
+    indptr, indices = graph.indptr, graph.indices
+    # number of infected neighbors of every node, kept up to date on every
+    # transition into or out of the infected compartment
+    inf_neighbors = graph.count_neighbors(1).tolist()
+    q = EventQueue(len(graph), comp)
+    # only infected nodes and susceptible ones next to them have an event
+    for node in np.flatnonzero((graph.comp == 1) | (np.asarray(inf_neighbors) != 0)).tolist():
+        q.schedule(node, events.next_event(comp[node], inf_neighbors[node], 0))
+    # number of susceptible nodes with an infection pending
+    exposed = sum(1 for node, state in enumerate(q.states) if state == 1)
+
+    processed, scanned = 0, 0
+    loop_start = time.perf_counter()
+    while infected != 0 and exposed != 0:
+        event = q.pop()
+        if event is None:
             break
+        global_time, node, new_state = event
 
         #SAMPLING
-        if current_event[2] == -1 and current_event[0] != 0:
-            res.append(prev)
-            prev=copy.deepcopy(res[len(res)-1])
+        while tick < len(ticks) and ticks[tick] <= global_time:
+            samples[row] = c_inf
+            row += 1
+            tick += 1
 
-            c_inf_res.append(c_inf_prev)
-            c_inf_prev=copy.deepcopy(c_inf_res[len(c_inf_res)-1])
+        if global_time > mp.time:
+            break
+
+        #RESAMPLE, a superseded infection time of a susceptible node came up
+        if new_state == -1:
+            pending = q.states[node] == 1
+            q.schedule(node, events.infection(inf_neighbors[node], global_time))
+            exposed += (q.states[node] == 1) - pending
             continue
 
-        old_state = nodes[current_event[2]].comp
-        new_state = current_event[1]
+        #UPDATE THE SIM
+        old_state = comp[node]
+        if old_state == 0:
+            c_inf[old_state]-=1
+            infected += 1
+            exposed -= 1
+        else:
+            infected -= 1
+        c_inf[new_state]+=1
 
-        if new_state > old_state and old_state != 2 and nodes[current_event[2]].eventID == current_event[3]:
-            #UPDATE THE SIM
-            prev[old_state]-=1
-            prev[new_state]+=1
+        comp[node] = new_state
+        neighbors = indices[indptr[node]:indptr[node+1]].tolist()
+        processed += 1
+        scanned += len(neighbors)
+        #TRANSMISSION
+        if new_state == 1:
+            states = q.states
+            for n in neighbors:
+                inf_neighbors[n] += 1
+                if comp[n] == 0:
+                    pending = states[n] == 1
+                    q.schedule(n, events.infection(inf_neighbors[n], global_time))
+                    exposed += (states[n] == 1) - pending
+        else:
+            # infection times already drawn for the neighbors stay pending
+            for n in neighbors:
+                inf_neighbors[n] -= 1
 
-            if old_state == 0:
-                c_inf_prev[old_state]-=1
-            c_inf_prev[new_state]+=1
+        #GENERATE NEW EVENT
+        q.schedule(node, events.next_event(new_state, inf_neighbors[node], global_time))
 
-            nodes[current_event[2]].comp = new_state
-            #TRANSMISSION
-            if new_state == 1:
-                for n in nodes[current_event[2]].neighbors:
-                    e=next_event(n, global_time, mp)
-                    q.put(e)
+    graph.comp[:] = comp
+    tail_start = time.perf_counter()
 
-        #GENERATE NEW EVENT
-        e=next_event(nodes[current_event[2]], global_time, mp)
-        q.put(e)
+    #ABSORBED, nothing but the pending exits of infected nodes can happen
+    if row < len(samples):
+        times, nodes, states = q.drain()
+        samples[row:] = c_inf
+        for state in (2, 3):
+            exits = np.sort(times[states == state])
+            samples[row:, state] += np.searchsorted(exits, ticks[tick:], side='right')
+        # infections still pending once no infected node is left never happen
+        done = (times <= mp.time) & (states != 1)
+        graph.comp[nodes[done]] = states[done]
 
-    if prev[1] == 0:
-        res.append(prev)
-        c_inf_res.append(c_inf_prev)
+    if stats is not None:
+        stats.update(events=processed, stale=q.stale, queue_max=q.high_water, neighbor_scans=scanned,
+                     setup_s=loop_start - start, loop_s=tail_start - loop_start,
+                     tail_s=time.perf_counter() - tail_start)
 
     # sub, c_inf, rec, dead
-    return c_inf_res
+    return samples
+
+# Tau-leaping approximation of run_model for len(mps) independent replicas
+# on the same network, advanced together in steps of sample_time / substeps
+# (time and sample_time of mps[0] are used for all of them). Within a step
+# every infected node leaves with probability 1 - exp(-i_out * tau), and
+# every susceptible node with an infection pending is infected with
+# probability 1 - exp(-infectiousness * k * tau). As in run_model, k is the
+# number of infected neighbors the pending infection was drawn with: it is
+# drawn again whenever a neighbor gets infected and whenever a superseded
+# infection time of the node comes up (those times are kept per node), but
+# not when infected neighbors leave, and a replica stops infecting once it
+# has no infected node or no pending infection left. Returns the
+# (m, ticks + 1, 4) samples, samples[i] having the layout run_model returns
+# for mps[i].
+def run_ensemble(mps, graph: Network, rng: np.random.Generator = None, substeps=4):
+    rng = np.random.default_rng() if rng is None else rng
+    m, n = len(mps), len(graph)
+    ticks = int(mps[0].time/mps[0].sample_time)
+    tau = mps[0].time / ticks / substeps
+    infectiousness = np.array([mp.infectiousness for mp in mps])
+    p_out = -np.expm1(-np.array([mp.i_out for mp in mps]) * tau)
+    p_rec = p_out * np.array([mp.i_rec_prop for mp in mps])
+
+    replicas = Replicas(graph, [mp.initial_infected for mp in mps], rng)
+    inf_neighbors = replicas.inf_neighbors.reshape(-1)
+    comp = replicas.comp.reshape(-1)
+    # infected neighbors the pending infection of every cell was drawn with, 0 if none
+    drawn = np.where(infectiousness[:, None] > 0, replicas.inf_neighbors, 0).reshape(-1)
+    # superseded infection times still to come up, of the cells `stale`
+    stale, stale_times = np.empty(0, np.int64), np.empty(0)
+
+    # Times at which infections drawn for `cells` with `counts` infected
+    # neighbors come up, for the cells with a nonzero infection rate.
+    def draw(cells, counts, now):
+        rates = infectiousness[cells // n] * counts
+        cells, rates = cells[rates > 0], rates[rates > 0]
+        return cells, now + rng.standard_exponential(len(cells)) / rates
+
+    # sub, c_inf, rec, dead
+    samples = np.zeros((m, ticks + 1, 4))
+    samples[:, 0] = replicas.results
+    samples[:, 0, 1] = n - replicas.results[:, 0]
+    now = 0.0
+    for t in range(1, ticks + 1):
+        for _ in range(substeps):
+            now += tau
+            exposed, infected = np.flatnonzero((drawn != 0) & (comp == 0)), replicas.infected
+            x = rng.random(len(exposed))
+            p_inf = -np.expm1(-infectiousness[exposed // n] * drawn[exposed] * tau)
+            infect = exposed[x < p_inf]
+
+            x = rng.random(len(infected))
+            recovered = x < p_rec[infected // n]
+            leave = x < p_out[infected // n]
+            replicas.update(infect, leave, np.where(recovered[leave], 2, 3))
+
+            # every new infected neighbor and every superseded time that came
+            # up supersedes the pending infection of a susceptible cell by one
+            # drawn from its current number of infected neighbors
+            cells, gained = graph.neighbor_cells(infect, m)
+            due = stale_times <= now
+            redraws = np.concatenate((np.repeat(cells, gained), stale[due]))
+            stale, stale_times = stale[~due], stale_times[~due]
+            cells, times = np.unique(redraws[comp[redraws] == 0], return_counts=True)
+            extra = np.repeat(cells, times - 1)
+            old, old_times = draw(cells, drawn[cells], now)
+            new, new_times = draw(extra, inf_neighbors[extra], now)
+            drawn[cells] = np.where(infectiousness[cells // n] > 0, inf_neighbors[cells], 0)
+            stale = np.concatenate((stale, old, new))
+            stale_times = np.concatenate((stale_times, old_times, new_times))
+
+            # replicas without infected nodes or pending infections stop
+            # infecting, only the exits of their infected nodes are left
+            pending = np.bincount(np.flatnonzero((drawn != 0) & (comp == 0)) // n, minlength=m)
+            stopped = (replicas.results[:, 1] == 0) | (pending == 0)
+            drawn.reshape(m, n)[stopped] = 0
+            keep = (comp[stale] == 0) & ~stopped[stale // n]
+            stale, stale_times = stale[keep], stale_times[keep]
+
+        results = replicas.results
+        samples[:, t] = results
+        samples[:, t, 1] = n - results[:, 0]
+
+        # once no replica has infected nodes left, nothing changes anymore
+        if not results[:, 1].any():
+            samples[:, t + 1:] = samples[:, t:t + 1]
+            break
+
+    return samples
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import glob
 import os
+import sqlite3
+import tempfile
 import numpy as np
 import pandas as pd
 import zlib
@@ -10,6 +13,9 @@ from collections import namedtuple
 
 from typing import *
 
+from .format import TIMESERIES_DTYPE, interpolation_weights
+from .historical import HistoricalDataset
+
 
 class Split(namedtuple('Split', 'X y')):
     __slots__ = ()
@@ -30,21 +36,97 @@ def serialize_np(x):
 def deserialize_np(x):
     return pickle.loads(zlib.decompress(base64.b64decode(x)))
 
+
+# Columns of an exported dataset CSV (and of SyntheticDataset.y, with 'case' as the index)
+PARAMETER_COLUMNS = ['case', 'population', 'initial_infected', 'network', 'k',
+                     'infectiousness', 'i_out', 'i_rec_prop']
+
+
+def encode_timeseries(x: np.ndarray) -> bytes:
+    return np.ascontiguousarray(x, dtype=TIMESERIES_DTYPE).tobytes()
+
+
+def decode_timeseries(blob: bytes, shape: Tuple[int, int]) -> np.ndarray:
+    return np.frombuffer(blob, dtype=TIMESERIES_DTYPE).reshape(shape)
+
+
+# Decodes a sequence of blobs into one contiguous (len(blobs), *shape) array.
+def stack_timeseries(blobs, shape: Tuple[int, int]) -> np.ndarray:
+    blobs = list(blobs)
+    z = np.empty((len(blobs),) + tuple(shape), dtype=TIMESERIES_DTYPE)
+    for i, blob in enumerate(blobs):
+        z[i] = decode_timeseries(blob, shape)
+    return z
+
+
+# Path of the .npy file holding the (n_cases, incidences, columns)
+# timeseries of a dataset CSV, in the same row order as the CSV (next to the
+# CSV itself if it is a symbolic link).
+def timeseries_path(csv: str) -> str:
+    return _stem(csv) + '.npy'
+
+
+# Path of the `shard`th compressed .npz file of a dataset CSV's timeseries,
+# the alternative to the .npy written by synda_db.export(compress=True).
+# Every shard holds the next rows of the CSV as a `timeseries` array.
+def timeseries_shard_path(csv: str, shard: int) -> str:
+    return '{}-part-{:05d}.npz'.format(_stem(csv), shard)
+
+
+# Paths of the existing .npz shards of a dataset CSV, in row order.
+def timeseries_shards(csv: str) -> List[str]:
+    return sorted(glob.glob(glob.escape(_stem(csv)) + '-part-[0-9][0-9][0-9][0-9][0-9].npz'))
+
+
+# Returns the (rows, incidences, columns) timeseries of a dataset CSV with
+# `rows` cases: the .npz shards decompressed one at a time (into a temporary
+# file when chunked), or else the .npy memory-mapped.
+def load_timeseries(csv: str, rows: int, chunked: bool = False) -> np.ndarray:
+    shards = timeseries_shards(csv)
+    if not shards:
+        return np.load(timeseries_path(csv), mmap_mode='r')
+
+    out, row = None, 0
+    for shard in shards:
+        with np.load(shard) as z:
+            x = z['timeseries']
+        if out is None:
+            shape = (rows,) + x.shape[1:]
+            out = _Spill().allocate(shape) if chunked else np.empty(shape, dtype=TIMESERIES_DTYPE)
+        out[row:row + len(x)] = x
+        row += len(x)
+    return out
+
+
+# Path of a dataset CSV without its extension, with symbolic links resolved
+# so the timeseries are found next to the file a link (e.g. a guild
+# requirement) points to.
+def _stem(csv: str) -> str:
+    csv = os.path.realpath(csv)
+    for suffix in ('.csv.gz', '.csv'):
+        if csv.endswith(suffix):
+            return csv[:-len(suffix)]
+    return csv
+
 # NOTE(kosi): Assume that first column is STEP in timeseries data
 
 
 def preprocess_timeseries(ts: np.ndarray, incidences: int) -> np.ndarray:
     ts[:, 1:] = ts[:, 1:] / ts[0, 1:].sum()
+    lo, hi, w = interpolation_weights(ts.shape[0], incidences)
+    return ts[lo] * (1 - w)[:, None] + ts[hi] * w[:, None]
 
-    old_ax = np.linspace(0, ts.shape[0], ts.shape[0])
-    new_ax = np.linspace(0, ts.shape[0], incidences)
-
-    z = np.zeros((incidences, ts.shape[1]))
 
-    for compartment in range(ts.shape[1]):
-        z[:, compartment] = np.interp(new_ax, old_ax, ts[:, compartment])
+# Preprocesses the (m, rows, compartments) samples of an ensemble run into a
+# (m, incidences, compartments + 1) array with the STEP column prepended, the
+# same as preprocess_timeseries on every replica.
+def preprocess_ensemble(samples: np.ndarray, incidences: int) -> np.ndarray:
+    m, rows, _ = samples.shape
+    steps = np.broadcast_to(np.arange(rows, dtype=np.float64)[None, :, None], (m, rows, 1))
+    ts = np.concatenate((steps, samples / samples[:, :1].sum(axis=2, keepdims=True)), axis=2)
 
-    return z
+    lo, hi, w = interpolation_weights(rows, incidences)
+    return ts[:, lo] * (1 - w)[:, None] + ts[:, hi] * w[:, None]
 
 
 class SyntheticDataset:
@@ -77,11 +159,29 @@ class SyntheticDataset:
     def __len__(self) -> int:
         return len(self._internal)
 
+    """
+    Returns the row positions of every split as index arrays, taken from one
+    permutation of the dataset (see split for the arguments).
+    """
+
+    def split_indices(self, partition: List[float] = [0.7, 0.3], shuffle: bool = True,
+                      seed: Optional[int] = None) -> List[np.ndarray]:
+        remainder = 1 - sum(partition)
+        assert(remainder >= 0)
+
+        length = len(self)
+        bounds = (length * np.cumsum([0] + list(partition))).astype(int)
+
+        order = np.random.default_rng(seed).permutation(length) if shuffle else np.arange(length)
+
+        return [order[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
     """
     Returns a list of splits (X and y pairs).
 
     partition: list of fraction each split should be
     shuffle: whether or not the list should be in random order
+    seed: seed of the shuffle, the same seed always gives the same splits
 
     e.g.
 
@@ -89,45 +189,157 @@ class SyntheticDataset:
     (train will be 70% of dataset, test will be 20%, rest is thrown away)
     """
 
-    def split(self, partition: List[int] = [0.7, 0.3], shuffle: bool = True) -> List[Split]:
-        remainder = 1 - sum(partition)
-        assert(remainder >= 0)
+    def split(self, partition: List[float] = [0.7, 0.3], shuffle: bool = True,
+              seed: Optional[int] = None) -> List[Split]:
+        codes = self._internal.copy()
+        for variable in self.categorical_variables:
+            codes[variable] = codes[variable].cat.codes
 
-        def __transform(df):
-            X = df.timeseries.apply(deserialize_np)
-            y = df.drop('timeseries', axis=1)
+        return [Split(self.timeseries[idx], codes.iloc[idx])
+                for idx in self.split_indices(partition, shuffle, seed)]
 
-            y.network = y.network.cat.codes
-            y.k = y.k.cat.codes
-            y.population = y.population.cat.codes
-            y.initial_infected = y.initial_infected.cat.codes
+    """
+    Returns the values of a variable as training targets: category codes for
+    categorical variables, float32 otherwise.
+    """
 
-            return Split(np.array(X.tolist(), dtype=np.float), y)
+    def labels(self, variable: str) -> np.ndarray:
+        if variable in self.categorical_variables:
+            return self.y[variable].cat.codes.to_numpy(np.int64)
+        return self.y[variable].to_numpy(np.float32)
 
-        previous = 0
-        length = len(self)
-        for i in range(len(partition)):
-            previous += partition[i]
-            partition[i] = int(length*previous)
+    """
+    Returns a tf.data pipeline of (timeseries, label) batches over the rows
+    `indices` (e.g. from split_indices, default all) that streams from
+    self.timeseries instead of copying the split into one tensor.
+
+    Rows are read `shard_rows` at a time, in index order within a shard so a
+    memory-mapped .npy is read sequentially, by `num_parallel_calls` readers.
+    With cache set, decoded shards are cached to that file prefix (one per
+    pipeline, e.g. a train and a valid one) after the first epoch; an existing
+    cache is reused as is, so remove it when the dataset or split changes. When
+    shuffling, the shard order is reshuffled every epoch and rows are mixed
+    in a bounded buffer of `shuffle_buffer` rows.
+
+    e.g.
 
-        splittable = self._internal
+    train_idx, valid_idx = synda.split_indices([0.8, 0.2], seed=0)
+    train = synda.to_tf_dataset('infectiousness', train_idx, batch_size=32, cache='/tmp/train')
+    """
+
+    def to_tf_dataset(self, variable: str, indices: Optional[np.ndarray] = None, batch_size: int = 32,
+                      shuffle: bool = True, shuffle_buffer: int = 4096, shard_rows: int = 1024,
+                      cache: Optional[str] = None, seed: Optional[int] = None, num_parallel_calls: int = None):
+        import tensorflow as tf
+
+        autotune = tf.data.AUTOTUNE
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices)
+        shards = [np.sort(indices[a:a + shard_rows]) for a in range(0, len(indices), shard_rows)]
+        labels = self.labels(variable)
+        timeseries = self.timeseries
+
+        def read(shard):
+            idx = shards[shard]
+            return np.asarray(timeseries[idx], dtype=np.float32), labels[idx]
+
+        def load(shard):
+            X, y = tf.numpy_function(read, [shard], (tf.float32, tf.as_dtype(labels.dtype)))
+            X.set_shape((None,) + timeseries.shape[1:])
+            y.set_shape((None,))
+            return X, y
+
+        ds = tf.data.Dataset.range(len(shards))
+        ds = ds.map(load, num_parallel_calls=num_parallel_calls or autotune, deterministic=True)
+        if cache is not None:
+            ds = ds.cache(cache)
+        if shuffle:
+            ds = ds.shuffle(len(shards), seed=seed, reshuffle_each_iteration=True)
+        ds = ds.unbatch()
         if shuffle:
-            splittable = splittable.sample(frac=1)
+            ds = ds.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
 
-        splits = list(map(__transform, np.split(splittable, partition)))
+        return ds.batch(batch_size).prefetch(autotune)
 
-        return splits[:len(partition)]
+    """
+    Loads a dataset CSV. Timeseries are read from the compressed .npz shards
+    next to it (see timeseries_shards), or from the .npy file next to it (see
+    timeseries_path) without copying, or, for CSVs written before either
+    format, decoded from the serialize_np timeseries column.
 
-    # TODO(kosi): Implement chunking for larger CSVs.
+    chunked: read the CSV `chunksize` rows at a time, spilling decoded
+    timeseries to a temporary file instead of keeping them in memory.
+    """
 
-    def __init__(self, csv: str = None, chunked: bool = False):
-        assert(not chunked)
+    def __init__(self, csv: str = None, chunked: bool = False, chunksize: int = 4096):
         if csv is None:
             csv = os.path.join(os.path.dirname(__file__),
                                'synthetic-dataset-100.csv.gz')
 
-        df = pd.read_csv(csv, compression='gzip')
+        if chunked:
+            reader = pd.read_csv(csv, compression='gzip', chunksize=chunksize)
+            timeseries = _Spill()
+        else:
+            reader = [pd.read_csv(csv, compression='gzip')]
+            timeseries = []
+
+        frames = []
+        for df in reader:
+            if 'timeseries' in df:
+                timeseries.append(np.stack(df.timeseries.apply(deserialize_np).tolist()).astype(TIMESERIES_DTYPE))
+                df = df.drop('timeseries', axis=1)
+            frames.append(df)
+
+        if chunked and timeseries.n:
+            timeseries = timeseries.array()
+        elif not chunked and timeseries:
+            timeseries = timeseries[0]
+        else:
+            timeseries = load_timeseries(csv, sum(map(len, frames)), chunked)
+
+        self._setup(pd.concat(frames, ignore_index=True), timeseries)
+
+    """
+    Loads a dataset straight from a table of the database written by generate_synda, reading
+    `chunksize` rows at a time. With chunked=True the timeseries are kept in a temporary file.
+    """
 
+    @classmethod
+    def from_database(cls, database_name: str, table_name: str, chunked: bool = False, chunksize: int = 4096):
+        conn = sqlite3.connect(database_name)
+        shape = conn.execute('SELECT incidences, columns FROM TIMESERIES_SHAPES WHERE [table] = ?',
+                             (table_name,)).fetchone()
+        if shape is None:
+            conn.close()
+            raise KeyError('no timeseries shape recorded for table ' + table_name)
+        n = conn.execute('SELECT COUNT(*) FROM {}'.format(table_name)).fetchone()[0]
+
+        if chunked:
+            timeseries = _Spill().allocate((n,) + shape)
+        else:
+            timeseries = np.empty((n,) + shape, dtype=TIMESERIES_DTYPE)
+
+        columns = PARAMETER_COLUMNS
+        cursor = conn.execute('SELECT {}, timeseries FROM {} ORDER BY rowid'.format(
+            ', '.join('[{}]'.format(c) for c in columns), table_name))
+
+        frames = []
+        row = 0
+        while True:
+            rows = cursor.fetchmany(chunksize)
+            if not rows:
+                break
+            frames.append(pd.DataFrame([r[:-1] for r in rows], columns=columns))
+            for r in rows:
+                timeseries[row] = decode_timeseries(r[-1], shape)
+                row += 1
+
+        conn.close()
+
+        dataset = cls.__new__(cls)
+        dataset._setup(pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns), timeseries)
+        return dataset
+
+    def _setup(self, df: pd.DataFrame, timeseries: np.ndarray):
         df.network = pd.Categorical(df.network)
         df.k = pd.Categorical(df.k)
         df.population = pd.Categorical(df.population)
@@ -136,6 +348,32 @@ class SyntheticDataset:
         df.set_index(["case"], inplace=True, drop=True)
 
         self._internal = df
-
-        self.X = df.timeseries.apply(deserialize_np)
-        self.y = df.drop('timeseries', axis=1)
+        self.timeseries = timeseries
+
+        self.X = pd.Series(list(self.timeseries), index=df.index)
+        self.y = df
+
+
+# Collects float32 timeseries in an unnamed temporary file and maps them back
+# as one (n, incidences, columns) array, so that loading never holds more
+# than one chunk of decoded timeseries in memory.
+class _Spill:
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.shape = None
+        self.n = 0
+
+    def append(self, x: np.ndarray):
+        self.shape = x.shape[1:]
+        self.n += len(x)
+        self.file.write(np.ascontiguousarray(x, dtype=TIMESERIES_DTYPE).tobytes())
+
+    def allocate(self, shape) -> np.ndarray:
+        # an empty file cannot be mapped
+        if 0 in tuple(shape):
+            return np.empty(shape, dtype=TIMESERIES_DTYPE)
+        return np.memmap(self.file, dtype=TIMESERIES_DTYPE, mode='w+', shape=tuple(shape))
+
+    def array(self) -> np.ndarray:
+        self.file.flush()
+        return np.memmap(self.file, dtype=TIMESERIES_DTYPE, mode='r', shape=(self.n,) + tuple(self.shape))
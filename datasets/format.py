@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from typing import *
+
+
+# Timeseries are stored as raw little-endian float32 blobs, all of one
+# (incidences, columns) shape that is recorded once per table rather than
+# per row (see synda_db.TIMESERIES_SHAPES).
+TIMESERIES_DTYPE = np.dtype('<f4')
+
+
+# Linear interpolation of `rows` evenly spaced samples at `incidences` evenly
+# spaced points: point i is rows[lo[i]] * (1 - w[i]) + rows[hi[i]] * w[i].
+# One np.interp finds the fractional row of every point for all columns.
+def interpolation_weights(rows: int, incidences: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    old_ax = np.linspace(0, rows, rows)
+    new_ax = np.linspace(0, rows, incidences)
+
+    position = np.interp(new_ax, old_ax, np.arange(rows))
+    lo = np.floor(position).astype(np.int64)
+    hi = np.minimum(lo + 1, rows - 1)
+    return lo, hi, position - lo
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from typing import *
+
+from .format import TIMESERIES_DTYPE, interpolation_weights
+
+
+# Columns naming the region of a row in the CSVs written by
+# fetch_us_historical (state) and fetch_world_historical (country)
+REGION_COLUMNS = ['state', 'country']
+
+# Cumulative counts of the historical CSVs that map to a compartment of the
+# simulated timeseries
+CASES = 'positive'
+DEATHS = 'death'
+
+
+class HistoricalDataset:
+    """
+    Real-world case counts (datasets/us_historical.csv or
+    datasets/world_historical.csv) in a region-partitioned store: the rows of
+    all regions sorted by region and date, those of region i being
+    values[offsets[i]:offsets[i + 1]], with their dates as days since the
+    epoch in days.
+
+    The CSV is parsed once into .npy files in the directory `<name>.store`
+    next to it, which later loads map instead of parsing, and which is
+    rebuilt when the CSV is newer.
+
+    e.g.
+
+    us = HistoricalDataset('datasets/us_historical.csv')
+    us['CA'].loc['2020-04']
+    X = us.to_timeseries(401, populations, missing=0.0)  # (len(us.regions), 401, 5)
+    """
+
+    # regions: (r,) region names, in store order
+    regions: List[str]
+
+    # fields: names of the columns of values
+    fields: List[str]
+
+    # offsets: (r + 1,) int64 row offsets of every region
+    offsets: np.ndarray
+
+    # days: (rows,) int32 date of every row as days since 1970-01-01
+    days: np.ndarray
+
+    # values: (rows, len(fields)) float64 counts, NaN where not reported
+    values: np.ndarray
+
+    def __init__(self, csv: str = None):
+        if csv is None:
+            csv = os.path.join(os.path.dirname(__file__), 'us_historical.csv')
+
+        store = store_path(csv)
+        index = os.path.join(store, 'index.json')
+        if not os.path.exists(index) or os.path.getmtime(index) < os.path.getmtime(csv):
+            build_store(csv, store)
+
+        with open(index) as f:
+            meta = json.load(f)
+        self.regions = meta['regions']
+        self.fields = meta['fields']
+        self.offsets = np.load(os.path.join(store, 'offsets.npy'))
+        self.days = np.load(os.path.join(store, 'days.npy'), mmap_mode='r')
+        self.values = np.load(os.path.join(store, 'values.npy'), mmap_mode='r')
+        self._region_index = {region: i for i, region in enumerate(self.regions)}
+
+    def __len__(self) -> int:
+        return len(self.regions)
+
+    """
+    Returns the counts of a region as a DataFrame indexed by date.
+    """
+
+    def __getitem__(self, region: str) -> pd.DataFrame:
+        rows = self._rows(region)
+        dates = pd.DatetimeIndex(np.asarray(self.days[rows]).astype('datetime64[D]'), name='date')
+        return pd.DataFrame(np.asarray(self.values[rows]), index=dates, columns=self.fields)
+
+    """
+    Returns the first and last date of a region as datetime64[D].
+    """
+
+    def date_range(self, region: str) -> Tuple[np.datetime64, np.datetime64]:
+        rows = self._rows(region)
+        return np.datetime64(int(self.days[rows.start]), 'D'), np.datetime64(int(self.days[rows.stop - 1]), 'D')
+
+    """
+    Returns the counts of `regions` (default all) in the layout of
+    preprocess_timeseries, as one (len(regions), incidences, 5) array that
+    can be fed to a model trained on SyntheticDataset.timeseries in one call.
+
+    Every region's dates, from its first to its last row, are resampled to
+    `incidences` evenly spaced points, linearly interpolating its cumulative
+    counts (counts not reported on a date carry over the last reported
+    ones, or 0 before the first). The columns are [step, susceptible,
+    cumulative infected, recovered, dead], the last four as fractions of the
+    region's population, with cumulative infected the positive cases,
+    susceptible the rest of the population and recovered, which the
+    historical data does not have, set to `missing`. As in
+    preprocess_timeseries, step is the sample index of a simulated run of
+    `rows` samples that each point falls on, so every region's span maps
+    onto the span of the runs a model was trained on; date_range gives the
+    dates it covers.
+
+    populations: population of every region, as a mapping from region name,
+    an array in the order of regions or one number for all of them
+    missing: recovered fraction to fill in, an estimate (a number or an
+    array broadcasting to (len(regions), incidences)) or np.nan to leave it
+    out; a model fed a NaN column predicts NaN
+    rows: number of samples of the simulated runs before preprocessing (e.g.
+    401 for CONTINUOUS, 500 for DISCRETE), incidences if not given
+    """
+
+    def to_timeseries(self, incidences: int, populations: Union[Mapping[str, float], np.ndarray, float],
+                      missing: Union[float, np.ndarray], regions: Optional[List[str]] = None,
+                      rows: Optional[int] = None) -> np.ndarray:
+        regions = self.regions if regions is None else list(regions)
+        index = np.array([self._region_index[region] for region in regions], dtype=np.int64)
+
+        if isinstance(populations, Mapping):
+            populations = [populations[region] for region in regions]
+        populations = np.broadcast_to(np.asarray(populations, dtype=np.float64), (len(regions),))
+
+        fields = [self.fields.index(CASES), self.fields.index(DEATHS)]
+        counts = fill_forward(np.asarray(self.values)[:, fields], self.offsets)
+        days = np.asarray(self.days, dtype=np.float64)
+
+        # evenly spaced dates over every region's own span
+        first, last = days[self.offsets[index]], days[self.offsets[index + 1] - 1]
+        t = first[:, None] + (last - first)[:, None] * np.linspace(0, 1, incidences)
+
+        # rows are sorted by (region, day), so one search over region * span + day
+        # finds the row at or after every date within its own region
+        span = days.max() - days.min() + 1
+        keys = np.repeat(np.arange(len(self.regions)), np.diff(self.offsets)) * span + (days - days.min())
+        hi = np.searchsorted(keys, index[:, None] * span + (t - days.min()), side='left')
+        hi = np.minimum(hi, self.offsets[index + 1][:, None] - 1)
+        lo = np.maximum(hi - 1, self.offsets[index][:, None])
+        gap = days[hi] - days[lo]
+        w = np.divide(t - days[lo], gap, out=np.ones_like(t), where=gap > 0)
+
+        resampled = counts[lo] * (1 - w)[..., None] + counts[hi] * w[..., None]
+        cases, deaths = resampled[..., 0] / populations[:, None], resampled[..., 1] / populations[:, None]
+
+        # the STEP column preprocess_timeseries interpolates from the sample index
+        step_lo, step_hi, step_w = interpolation_weights(incidences if rows is None else rows, incidences)
+
+        ts = np.empty((len(regions), incidences, 5), dtype=TIMESERIES_DTYPE)
+        ts[..., 0] = step_lo * (1 - step_w) + step_hi * step_w
+        ts[..., 1] = 1 - cases
+        ts[..., 2] = cases
+        ts[..., 3] = missing
+        ts[..., 4] = deaths
+        return ts
+
+    def _rows(self, region: str) -> slice:
+        i = self._region_index[region]
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+
+# Directory of the parsed store of a historical CSV.
+def store_path(csv: str) -> str:
+    return (csv[:-len('.csv')] if csv.endswith('.csv') else csv) + '.store'
+
+
+# Parses a historical CSV into the store read by HistoricalDataset: days.npy,
+# values.npy and offsets.npy, and index.json with the region names and
+# fields, written last so a store is only used once it is complete.
+def build_store(csv: str, store: str):
+    df = pd.read_csv(csv)
+    region = next(c for c in REGION_COLUMNS if c in df.columns)
+    fields = [c for c in df.columns if c not in ('date', region)]
+
+    df = df.dropna(subset=[region]).sort_values([region, 'date'], kind='stable')
+    regions, counts = np.unique(df[region].to_numpy(str), return_counts=True)
+    offsets = np.zeros(len(regions) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    days = pd.to_datetime(df['date']).to_numpy('datetime64[D]').astype(np.int64).astype(np.int32)
+
+    os.makedirs(store, exist_ok=True)
+    np.save(os.path.join(store, 'days.npy'), days)
+    np.save(os.path.join(store, 'values.npy'), df[fields].to_numpy(np.float64))
+    np.save(os.path.join(store, 'offsets.npy'), offsets)
+    with open(os.path.join(store, 'index.json'), 'w') as f:
+        json.dump({'regions': regions.tolist(), 'fields': fields}, f)
+
+
+# Replaces the NaNs of every column of region-partitioned rows with the last
+# number above them in the same region, or 0 if there is none.
+def fill_forward(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    rows = np.arange(len(values))[:, None]
+    starts = np.repeat(offsets[:-1], np.diff(offsets))[:, None]
+
+    last = np.maximum.accumulate(np.where(np.isnan(values), -1, rows), axis=0)
+    filled = np.take_along_axis(values, np.maximum(last, 0), axis=0)
+    return np.where(last >= starts, filled, 0)
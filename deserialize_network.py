@@ -1,10 +1,50 @@
-from discrete_sim import Node
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import pickle
+from pathlib import Path
+from network import Network, load_network, save_network
+
+# Suffix of the binary network file cached next to a pickled adjacency list
+NETWORK_SUFFIX = '.csr'
 
 def deserialize_network (adj_list: list):
-    nodes = [None] * len(adj_list)
-    for i in range(len(adj_list)):
-        nodes[i] = Node()
-    for i in range(len(adj_list)):
-        for j in adj_list[i]:
-            nodes[i].add_edge(nodes[j])
-    return nodes
+    return Network.from_adj_list(adj_list)
+
+# Returns the network family and mean degree encoded in a graph file name (e.g. BA-8-4000).
+def parse_network_name(network_name):
+    return network_name.split('-')[0], int(network_name.split('-')[1])
+
+# Converts a pickled adjacency list into a binary network file next to it
+# and returns the path of that file.
+def convert_network(fn):
+    fn = Path(fn)
+    with open(fn, 'rb') as f:
+        graph = deserialize_network(pickle.load(f))
+
+    graph_type, k = parse_network_name(fn.name)
+    out = str(fn) + NETWORK_SUFFIX
+    save_network(graph, out, graph_type, k)
+    return out
+
+# Loads a network by the path of its pickle, through the memory-mapped
+# binary file next to it, which is (re)built first if missing or older.
+def load_cached_network(fn):
+    fn = str(fn)
+    cache = fn + NETWORK_SUFFIX
+    if os.path.exists(fn) and (not os.path.exists(cache) or os.path.getmtime(cache) < os.path.getmtime(fn)):
+        convert_network(fn)
+    return load_network(cache)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert pickled networks to memory-mappable binary files')
+    parser.add_argument('paths', nargs='+', help='network pickles or directories of them')
+
+    args = parser.parse_args()
+
+    for path in map(Path, args.paths):
+        files = sorted(path.iterdir()) if path.is_dir() else [path]
+        for fn in files:
+            if fn.suffix != NETWORK_SUFFIX and not fn.name.endswith('.tmp'):
+                print(convert_network(fn))
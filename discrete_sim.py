@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import random
+import time
+import numpy as np
 from enum import Enum
+from network import Network, Replicas
 
 T_COLUMNS = ['susceptible', 'infected', 'dead', 'recovered']
 P_COLUMNS = ['population', 'backend', 'initial_infected', 'network_name', 'infectiousness', 'i_d', 'i_r']
@@ -36,75 +38,134 @@ class ModelParameters:
     # determines the sample rate of the simulation, time_series information should only be captured every delta steps of the simulation
     delta: int
 
-class Node:
-    def __init__(self):
-        self.comp = 0
-        self.next_comp = 0
-        self.neighbors = []
-        # added for continuous sim
-        self.num = 0
-        self.eventID = 0
-
-    def add_edge(self, other):
-        self.neighbors.append(other)
-        other.neighbors.append(self)
-
-    def num_neighbors(self, comp):
-        out = 0
-        for other in self.neighbors:
-            if (other.comp == comp):
-                out += 1
-        return out
-
-    def has_neighbor(self, other):
-        return self.neighbors.count(other) > 0
-
-    def set_comp(self, comp):
-        self.comp = comp
-        self.next_comp = comp
-
-    def set_num(self, num):
-        self.num = num
-
-
-def set_initial_infected(nodes, inf):
+def set_initial_infected(graph: Network, inf, rng: np.random.Generator):
     while (inf > 0):
-        i = random.randint(0, len(nodes) - 1)
-        if (nodes[i].comp == 0):
-            nodes[i].set_comp(1)
+        i = int(rng.integers(len(graph)))
+        if (graph.comp[i] == 0):
+            graph.set_comp(i, 1)
             inf -= 1
 
-def step(mp: ModelParameters, nodes):
-    for node in nodes:
-        if (node.comp == 0):
-            if (random.random() < (mp.infectiousness * node.num_neighbors(1))):
-                node.next_comp = 1
-        elif (node.comp == 1):
-            x = random.random()
-            if (x < mp.i_d):
-                node.next_comp = 2
-            elif (x < mp.i_d + mp.i_r):
-                node.next_comp = 3
-    for node in nodes:
-        node.comp = node.next_comp
-
-def run_model(mp: ModelParameters, nodes):
-    maxtime, time_left = mp.maxtime, mp.maxtime
-    delta = mp.delta
-    timeseries_info = [None]*(maxtime // delta)
-
-    set_initial_infected(nodes, mp.initial_infected)
-    results = [-1]*4
-    while (results[1] != 0 and time_left > 0):
-        results = [0]*4
-        for node in nodes:
-            results[node.comp]+=1
-        # print(results)
-        if (maxtime - time_left) % delta == 0:
-            idx = (maxtime - time_left) // delta
-            timeseries_info[idx] = results
-        time_left -= 1
-        step(mp, nodes)
-    # print("done")
-    timeseries_info = [inf for inf in timeseries_info if inf is not None]
-    return timeseries_info
+# Advances the network one step. inf_neighbors, the number of infected
+# neighbors of every node, is computed if not given.
+def step(mp: ModelParameters, graph: Network, rng: np.random.Generator, inf_neighbors=None):
+    comp = graph.comp
+    susceptible = comp == 0
+    infected = comp == 1
+
+    # every node draws one number per step, like the scalar version did
+    x = rng.random(len(graph))
+    if inf_neighbors is None:
+        inf_neighbors = graph.adjacency().dot(infected.view(np.uint8))
+
+    next_comp = comp.copy()
+    next_comp[susceptible & (x < mp.infectiousness * inf_neighbors)] = 1
+    next_comp[infected & (x < mp.i_d)] = 2
+    next_comp[infected & (x >= mp.i_d) & (x < mp.i_d + mp.i_r)] = 3
+    graph.comp[:] = next_comp
+
+# Returns the (maxtime // delta, 4) counts of every compartment at steps 0,
+# delta, 2 * delta, ... Once the run is absorbed the remaining rows are filled
+# without stepping the whole network: with no infected node left they repeat
+# the last counts, and with no susceptible node next to an infected one only
+# the exits of the infected nodes are left, drawn all at once (see
+# fill_exits). rng is the numpy Generator every random draw of the run comes
+# from, a fresh unseeded one if not given. If stats is a dict, the counters of
+# the run are stored in it: steps taken, neighbors scanned (every step visits
+# every edge), and seconds spent in setup, the step loop and the absorbed tail.
+def run_model(mp: ModelParameters, graph: Network, rng: np.random.Generator = None, stats: dict = None):
+    start = time.perf_counter()
+    rng = np.random.default_rng() if rng is None else rng
+    maxtime, delta = mp.maxtime, mp.delta
+    samples = np.zeros((maxtime // delta, 4))
+
+    set_initial_infected(graph, mp.initial_infected, rng)
+    loop_start, tail_start = time.perf_counter(), None
+    steps, scans = 0, 0
+    for t in range(maxtime):
+        results = np.bincount(graph.comp, minlength=4)
+        if t % delta == 0:
+            samples[t // delta] = results
+
+        if results[1] == 0:
+            tail_start = time.perf_counter()
+            samples[t // delta + 1:] = results
+            break
+        inf_neighbors = graph.adjacency().dot((graph.comp == 1).view(np.uint8))
+        scans += len(graph.indices)
+        if not inf_neighbors[graph.comp == 0].any():
+            tail_start = time.perf_counter()
+            fill_exits(mp, graph, samples, t, rng)
+            break
+
+        step(mp, graph, rng, inf_neighbors)
+        steps += 1
+
+    if stats is not None:
+        end = time.perf_counter()
+        tail_start = end if tail_start is None else tail_start
+        stats.update(steps=steps, neighbor_scans=scans,
+                     setup_s=loop_start - start, loop_s=tail_start - loop_start, tail_s=end - tail_start)
+
+    return samples
+
+# Fills the rows of samples after step t, at which no susceptible node has an
+# infected neighbor: every infected node independently leaves after a
+# geometric number of steps, dead with probability i_d / (i_d + i_r).
+def fill_exits(mp: ModelParameters, graph: Network, samples, t, rng: np.random.Generator):
+    infected = np.flatnonzero(graph.comp == 1)
+    p_out = mp.i_d + mp.i_r
+    counts = np.bincount(graph.comp, minlength=4)
+
+    if p_out <= 0:
+        exit_step = np.full(len(infected), np.inf)
+    else:
+        exit_step = t + rng.geometric(min(p_out, 1.0), len(infected))
+    dead = rng.random(len(infected)) * p_out < mp.i_d
+
+    rows = np.arange(t // mp.delta + 1, len(samples))
+    steps = rows * mp.delta
+    samples[rows] = counts
+    for state, mask in ((2, dead), (3, ~dead)):
+        left = np.searchsorted(np.sort(exit_step[mask]), steps, side='right')
+        samples[rows, state] += left
+        samples[rows, 1] -= left
+
+    done = exit_step <= mp.maxtime
+    graph.comp[infected[done]] = np.where(dead[done], 2, 3)
+
+# Runs len(mps) independent replicas of the model on the same network in one
+# vectorized pass, only maxtime and delta of mps[0] are used. Returns the
+# (m, maxtime // delta, 4) samples, samples[i] having the layout run_model
+# returns for mps[i].
+def run_ensemble(mps, graph: Network, rng: np.random.Generator = None):
+    rng = np.random.default_rng() if rng is None else rng
+    m, n = len(mps), len(graph)
+    maxtime, delta = mps[0].maxtime, mps[0].delta
+    infectiousness = np.array([mp.infectiousness for mp in mps])
+    i_d = np.array([mp.i_d for mp in mps])
+    i_dr = i_d + np.array([mp.i_r for mp in mps])
+
+    replicas = Replicas(graph, [mp.initial_infected for mp in mps], rng)
+    inf_neighbors = replicas.inf_neighbors.reshape(-1)
+
+    samples = np.zeros((m, maxtime // delta, 4))
+    for t in range(maxtime):
+        results = replicas.results
+        if t % delta == 0:
+            samples[:, t // delta] = results
+        # once no replica has infected nodes left, nothing changes anymore
+        if not results[:, 1].any():
+            samples[:, t // delta + 1:] = results[:, None]
+            break
+
+        # only infected nodes and susceptible nodes next to one can move
+        exposed, infected = replicas.exposed(), replicas.infected
+        x = rng.random(len(exposed))
+        infect = exposed[x < infectiousness[exposed // n] * inf_neighbors[exposed]]
+
+        x = rng.random(len(infected))
+        dead = x < i_d[infected // n]
+        leave = x < i_dr[infected // n]
+        replicas.update(infect, leave, np.where(dead[leave], 2, 3))
+
+    return samples
@@ -69,7 +69,8 @@ def determine_optimizer():
     return optimizer
 
 def train_model(model, train, valid, callbacks):
-    model.fit(train, epochs=epochs, batch_size=batch_size, verbose=1, validation_data=valid, callbacks=callbacks)
+    # train and valid are already batched tf.data pipelines
+    model.fit(train, epochs=epochs, verbose=1, validation_data=valid, callbacks=callbacks)
 
 if __name__ == "__main__":
     # Seed random number generators to start w/ same weights + biases
@@ -126,6 +127,12 @@ if __name__ == "__main__":
     # Whether or not to use early stopping
     parser.add_argument('--early_stopping', type=bool, default=False)
 
+    # Number of rows the training set is shuffled in
+    parser.add_argument('--shuffle_buffer', type=int, default=4096)
+
+    # Directory to cache decoded timeseries in (none if empty)
+    parser.add_argument('--cache_dir', type=str, default='')
+
     args = parser.parse_args()
 
     # Hyperparameters
@@ -140,6 +147,8 @@ if __name__ == "__main__":
     gradient_clipping = args.gradient_clipping
     variable          = args.variable
     early_stopping    = args.early_stopping
+    shuffle_buffer    = args.shuffle_buffer
+    cache_dir         = args.cache_dir
 
     # Import synthetic data set
     synda = SyntheticDataset('synthetic-dataset-100.csv.gz')
@@ -151,17 +160,24 @@ if __name__ == "__main__":
     print("dataset_size: {}".format(len(synda)))
 
     # Get split train and validation set
-    train, valid = synda.split([0.8, 0.2])
+    train_idx, valid_idx = synda.split_indices([0.8, 0.2], seed=MAGIC)
 
     # Grab the input shape
-    input_shape = train.X.shape[1:]
+    input_shape = synda.timeseries.shape[1:]
+
+    print("train_size: {}".format(len(train_idx)))
+    print("valid_size: {}".format(len(valid_idx)))
 
-    print("train_size: {}".format(len(train.X)))
-    print("valid_size: {}".format(len(valid.X)))
+    # Stream batches of both sets from the dataset
+    train_cache, valid_cache = None, None
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        train_cache, valid_cache = os.path.join(cache_dir, 'train'), os.path.join(cache_dir, 'valid')
 
-    # Convert to tensorflow datasets
-    train = tf.data.Dataset.from_tensors((train.X, train.variable(variable)))
-    valid = tf.data.Dataset.from_tensors((valid.X, valid.variable(variable)))
+    train = synda.to_tf_dataset(variable, train_idx, batch_size=batch_size, shuffle_buffer=shuffle_buffer,
+                                cache=train_cache, seed=MAGIC)
+    valid = synda.to_tf_dataset(variable, valid_idx, batch_size=batch_size, shuffle=False,
+                                cache=valid_cache)
 
     # Determine shapes, metrics, and loss function
     loss, metrics, optimizer, callbacks = determine_F()
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import random
 import pickle
+import numpy as np
+from network import Network, RandomBuffer, random_stream, save_network
+from deserialize_network import NETWORK_SUFFIX
 import argparse
 from enum import Enum
 from tqdm import tqdm
@@ -30,20 +32,46 @@ def replace_dir(dir_name):
     # there is no name collision.
     os.makedirs(NETWORK_FOLDER)
 
-def dist(node1: tuple, node2: tuple):
-    return ((node1[0] - node2[0])**2 + (node1[1] - node2[1])**2)**(1/2)
-
-def gn_setup(n, kmean):
+def gn_setup(n, kmean, rng):
     radius = (kmean/(n*math.pi))**(1/2)
-    adj_list = setup_adj_list(n)
-    nodes = [None] * n
-    for i in range(n):
-        nodes[i] = random.random(), random.random()
-    for i in range(n):
-        for j in range(i+1, n):
-            if (dist(nodes[i], nodes[j]) < radius):
-                adj_list[i].append(j)
-    return adj_list
+    i, j = gn_edges(rng.random((n, 2)), radius)
+    return adj_list_from_edges(n, i, j)
+
+def gn_edges(points, radius):
+    # Returns the pairs (i < j) of points closer than radius. Points are
+    # bucketed into a grid of cells at least radius wide, so only pairs in
+    # the same or adjacent cells need their distance checked.
+    n = len(points)
+    g = max(1, int(1 / radius))
+    cells = np.minimum((points * g).astype(np.int64), g - 1)
+    cell_id = cells[:, 0] * g + cells[:, 1]
+
+    order = np.argsort(cell_id, kind='stable')
+    cells, points = cells[order], points[order]
+    starts = np.searchsorted(cell_id[order], np.arange(g * g))
+    ends = np.searchsorted(cell_id[order], np.arange(g * g), side='right')
+
+    src_all, dst_all = [], []
+    # the own cell and half of the neighbouring ones, the other half is
+    # covered from the other side
+    for dx, dy in ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1)):
+        nx, ny = cells[:, 0] + dx, cells[:, 1] + dy
+        p = np.flatnonzero((nx >= 0) & (nx < g) & (ny >= 0) & (ny < g))
+        neighbor = nx[p] * g + ny[p]
+        lo, hi = starts[neighbor], ends[neighbor]
+        if dx == 0 and dy == 0:
+            lo = p + 1
+
+        counts = np.maximum(hi - lo, 0)
+        src = np.repeat(p, counts)
+        dst = np.arange(counts.sum()) + np.repeat(lo - (np.cumsum(counts) - counts), counts)
+
+        close = np.sqrt(((points[src] - points[dst])**2).sum(axis=1)) < radius
+        src_all.append(order[src[close]])
+        dst_all.append(order[dst[close]])
+
+    src, dst = np.concatenate(src_all), np.concatenate(dst_all)
+    return np.minimum(src, dst), np.maximum(src, dst)
 
 def cg_setup(n):
     adj_list = setup_adj_list(n)
@@ -52,68 +80,88 @@ def cg_setup(n):
             adj_list[i].append(j)
     return adj_list
 
-def er_setup(n, k_mean):
-    adj_list = setup_adj_list(n)
+def er_setup(n, k_mean, rng):
     edges = (int) (k_mean * n / 2)
+    src, dst, keys = [], [], np.empty(0, dtype=np.int64)
     count = 0
     while (count < edges):
-        i = random.randint(0, n - 1)
-        j = random.randint(0, n - 1)
-        if (not(i == j or adj_list[i].count(j) > 0 or adj_list[j].count(i) > 0)):
-            adj_list[i].append(j)
-            count += 1
-    return adj_list
-
-def ws_setup(n, k, beta):
-    adj_list = setup_adj_list(n)
-    extra_edges = [0] * n
-    for i in range (n):
-        for j in range ((int) (k / 2)):
-            if (random.random() > beta):
-                adj_list[i].append((i + j + 1) % n)
-            else:
-                extra_edges[i] += 1
-    for i in range(n):
-        for x in range(extra_edges[i]):
-            j = random.randint(0, n - 1)
-            while(i == j or adj_list[i].count(j) > 0 or adj_list[j].count(i) > 0):
-                j = random.randint(0, n - 1)
-            adj_list[i].append(j)
-    return adj_list
-
-
-def ba_setup(n, k):
+        # draw a little more than needed to make up for rejected pairs
+        need = edges - count
+        i = rng.integers(0, n, need + need // 16 + 16)
+        j = rng.integers(0, n, len(i))
+        key = edge_keys(n, i, j)
+        ok = np.flatnonzero((i != j) & new_edges(key, keys))[:need]
+        src.append(i[ok])
+        dst.append(j[ok])
+        keys = np.sort(np.concatenate((keys, key[ok])))
+        count += len(ok)
+    return adj_list_from_edges(n, np.concatenate(src), np.concatenate(dst))
+
+def ws_setup(n, k, beta, rng):
+    half = (int) (k / 2)
+    i = np.repeat(np.arange(n), half).reshape(n, half)
+    j = (i + np.arange(1, half + 1)) % n
+    keep = rng.random((n, half)) > beta
+    src, dst = [i[keep]], [j[keep]]
+    keys = np.sort(edge_keys(n, i[keep], j[keep]))
+    # every dropped lattice edge is rewired from its source to a random node
+    todo = i[~keep]
+    while (len(todo) > 0):
+        j = rng.integers(0, n, len(todo))
+        key = edge_keys(n, todo, j)
+        ok = (todo != j) & new_edges(key, keys)
+        src.append(todo[ok])
+        dst.append(j[ok])
+        keys = np.sort(np.concatenate((keys, key[ok])))
+        todo = todo[~ok]
+    return adj_list_from_edges(n, np.concatenate(src), np.concatenate(dst))
+
+def edge_keys(n, i, j):
+    # packs the undirected edge (i, j) into a single integer
+    return np.minimum(i, j).astype(np.int64) * n + np.maximum(i, j)
+
+def new_edges(keys, existing):
+    # mask of the keys that are not in `existing` (sorted) and do not repeat
+    # an earlier key of the same batch
+    first = np.zeros(len(keys), dtype=bool)
+    first[np.unique(keys, return_index=True)[1]] = True
+    pos = np.minimum(np.searchsorted(existing, keys), max(len(existing) - 1, 0))
+    seen = existing[pos] == keys if len(existing) else np.zeros(len(keys), dtype=bool)
+    return first & ~seen
+
+def ba_setup(n, k, rng):
     m = k // 2
     adj_list = setup_adj_list(n)
-    edges = [0] * n
-    total_edges = 0
+    uniform = RandomBuffer(rng.random)
+    # every node appears once per edge it has, so a uniform pick from
+    # targets is a pick proportional to degree
+    targets = []
     for i in range(m):
         for j in range(i+1,m):
             adj_list[i].append(j)
-            edges[i] += 1
-            edges[j] += 1
-            total_edges += 1
+            targets.append(i)
+            targets.append(j)
     for i in range(m, n):
-        count = 0
-        while (count < m):
-            edge = random.randint(0, total_edges * 2)
-            for j in range(i):
-                edge -= edges[j]
-                if (edge <= 0):
-                    if (not(i == j or adj_list[i].count(j) > 0 or adj_list[j].count(i) > 0)):
-                        adj_list[i].append(j)
-                        edges[i] += 1
-                        edges[j] += 1
-                        count += 1
-                        total_edges += 1
-                    break
-                else:
-                    continue
-                break
-            else:
-                continue
+        chosen = set()
+        while (len(chosen) < m):
+            # i is already in targets once it has an edge, drawing it again
+            # is rejected just like a duplicate
+            u = uniform()
+            j = targets[int(u * len(targets))] if targets else int(u * i)
+            if (not(i == j or j in chosen)):
+                adj_list[i].append(j)
+                chosen.add(j)
+                targets.append(i)
+                targets.append(j)
     return adj_list
 
+def adj_list_from_edges(n, i, j):
+    # adj_list[i] holds the j of every edge (i, j), in increasing order
+    order = np.argsort(i.astype(np.int64) * n + j)
+    i, j = i[order], j[order].tolist()
+    ptr = np.searchsorted(i, np.arange(n + 1)).tolist()
+    return [j[ptr[a]:ptr[a + 1]] for a in range(n)]
+
 def setup_adj_list(n):
     adj_list = [None] * n
     for i in range(n):
@@ -133,8 +181,11 @@ if __name__ == "__main__":
     parser.add_argument('-G', '--graph', type=str, help='type of network')
     parser.add_argument('-K', '--k', type=int, help='average number of connected nodes')
     parser.add_argument('-N', '--number', type=int, help='population of nodes')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='base seed, the same seed always gives the same network for a graph type, k and N')
 
     args = parser.parse_args()
+    rng = random_stream(args.seed, args.graph, args.k, args.number)
 
     filename = Path(args.outdir) / create_filename(args.graph,
                                                    args.k,
@@ -142,13 +193,15 @@ if __name__ == "__main__":
 
     adj_list = None
     if args.graph == 'ER':
-        adj_list = er_setup(args.number, args.k)
+        adj_list = er_setup(args.number, args.k, rng)
     elif args.graph == 'WS':
-        adj_list = ws_setup(args.number, args.k, beta=0.2)
+        adj_list = ws_setup(args.number, args.k, beta=0.2, rng=rng)
     elif args.graph == 'BA':
-        adj_list = ba_setup(args.number, args.k)
+        adj_list = ba_setup(args.number, args.k, rng)
     elif args.graph == 'GN':
-        adj_list = gn_setup(args.number, kmean=args.k)
+        adj_list = gn_setup(args.number, kmean=args.k, rng=rng)
 
     with open(filename, 'wb') as output_file:
         pickle.dump(adj_list, output_file)
+
+    save_network(Network.from_adj_list(adj_list), str(filename) + NETWORK_SUFFIX, args.graph, args.k)
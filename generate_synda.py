@@ -2,27 +2,42 @@
 # -*- coding: utf-8 -*-
 from enum import Enum
 from pathlib import Path
-from deserialize_network import deserialize_network
-from datasets import preprocess_timeseries, serialize_np
+from deserialize_network import NETWORK_SUFFIX, load_cached_network, parse_network_name
+from network import random_stream
+from datasets import encode_timeseries, preprocess_ensemble, preprocess_timeseries
+import synda_db
+from synda_db import ResultSink, WorkLedger
+from simulation_cache import SimulationCache
 import argparse
-import pickle
-import random
-import sqlite3
+import cProfile
+import multiprocessing
+import os
+import queue
+import sys
+import time
 import numpy as np
 import pandas as pd
 import scipy.stats as stats
+from tqdm import tqdm
 import continuous_sim as continuous
 import discrete_sim as discrete
+import meanfield_sim as meanfield
 
 
 class ModelType(Enum):
     DISCRETE = 'DISCRETE'
     CONTINUOUS = 'CONTINUOUS'
+    # deterministic mean-field surrogate of CONTINUOUS, for screening parameters
+    MEANFIELD = 'MEANFIELD'
 
     def __str__(self):
         return self.name
 
 
+# Largest file GitHub accepts in a repository, which the exported dataset files are meant to fit in
+GITHUB_FILE_LIMIT = 100 * 2**20
+
+
 """
 Runs setup code needed depending on the model.
 """
@@ -34,10 +49,29 @@ def setup(args):
 
     fn = Path(network_dir) / graph_type
 
-    with open(fn, 'rb') as f:
-        graph = deserialize_network(pickle.load(f))
+    return load_cached_network(fn)
+
 
-    return graph
+"""
+Returns the simulation cache of args.cache_dir, or None if caching is off.
+"""
+
+
+def open_cache(args):
+    if not args.cache_dir:
+        return None
+    return SimulationCache(args.cache_dir, args.cache_size * 2**20)
+
+
+"""
+Returns the cache key of a run of case args.index with parameters mp: the digest of the network file
+setup() loads, the backend, the parameters and the case's random stream.
+"""
+
+
+def cache_key(args, cache, mp):
+    graph_file = str(Path(args.network_dir) / args.graph_type) + NETWORK_SUFFIX
+    return cache.key(cache.file_digest(graph_file), args.model, mp, (args.seed, args.graph_type, args.index))
 
 
 """
@@ -46,90 +80,362 @@ Resets the network
 
 
 def reset_network(graph):
-    for node in graph:
-        node.comp = 0
+    graph.reset()
+
+
+"""
+Returns the simulator module of a model type.
+"""
+
+
+def model_module(model):
+    if model == ModelType.CONTINUOUS:
+        return continuous
+    if model == ModelType.MEANFIELD:
+        return meanfield
+    return discrete
+
+
+"""
+Returns the random generator of case `index` on args.graph_type. Every case (or ensemble batch) gets
+its own stream derived from args.seed, so it comes out the same whichever worker runs it.
+"""
+
+
+def case_rng(args, index, *keys):
+    return random_stream(args.seed, args.graph_type, index, *keys)
 
 
 """
-Returns the time-series data and parameters from a simulation with randomized parameters.
+Returns randomized model parameters for a simulation on the graph.
 """
 
 
-def random_simulation(args, graph, X):
+def random_parameters(args, graph, X, rng):
     model = args.model
     network_name = args.graph_type
-    index = args.index
     incidences = args.incidences
 
-    model_module = discrete
-
-    if model == ModelType.CONTINUOUS:
-        model_module = continuous
-
     # Grossman paper has inf=3.
-    inf = random.choice([2, 4, 7, 10])
-    mp = model_module.ModelParameters()
+    inf = int(rng.choice([2, 4, 7, 10]))
+    mp = model_module(model).ModelParameters()
 
     mp.population = len(graph)
     mp.initial_infected = inf
-    mp.infectiousness = np.random.uniform(0.01, 0.25)
+    mp.infectiousness = rng.uniform(0.01, 0.25)
 
     # https://rt.live/ - based on lower and upper bounds from website
     # Based on data last collected from 7/21/20 at 5:55AM
     # lower bound (lowest estimate for utah)
     # upper bound (highest esimate for kentucky)
-    r0 = np.random.uniform(0.72, 1.64)
+    r0 = rng.uniform(0.72, 1.64)
 
     # R0 = k_mean * (infectiousness / (infectiousness + i_out))
     # i_out = infectiousness * ((kmean - r0) / r0)
-    k = int(network_name.split('-')[1])
-    network = network_name.split('-')[0]
+    _, k = parse_network_name(network_name)
 
     if model == ModelType.DISCRETE:
-        mp.i_d = np.random.uniform(0.0001, 0.25)
-        mp.i_r = np.random.uniform(0.001, 0.25)
-    elif model == ModelType.CONTINUOUS:
+        mp.i_d = rng.uniform(0.0001, 0.25)
+        mp.i_r = rng.uniform(0.001, 0.25)
+    elif model in (ModelType.CONTINUOUS, ModelType.MEANFIELD):
         # mp.i_out            = np.random.uniform(0.0001, 1)
         mp.i_out = mp.infectiousness * ((k - r0) / r0)
         # probability that when a person leaves the infected compartment they recover
-        mp.i_rec_prop = X.rvs()
+        mp.i_rec_prop = X.rvs(random_state=rng)
 
     if model == ModelType.DISCRETE:
         mp.delta = 1  # 1 step = 1 day
         mp.maxtime = 500  # at most simulation will run 500 steps
-    elif model == ModelType.CONTINUOUS:
+    elif model in (ModelType.CONTINUOUS, ModelType.MEANFIELD):
         mp.sample_time = 1/10  # 1/10 steps = 1 day
         # at most simulation will run 40 steps (maximum of 400 samples)
         mp.time = int(mp.sample_time * incidences)
 
-    timeseries = model_module.run_model(mp, graph)
-    reset_network(graph)
+    return mp
+
+
+"""
+Returns the dataset row of a simulation from its parameters and its preprocessed time-series. With a
+profile dict (see synda_db.PROFILE_COLUMNS) the time spent serializing is added to it and the row
+carries it in a `profile` column.
+"""
+
 
-    for i, r in enumerate(timeseries):
-        r.insert(0, i)
+def simulation_series(args, mp, index, timeseries, profile=None):
+    network_name = args.graph_type
+    network, k = parse_network_name(network_name)
 
-    timeseries = np.array(timeseries, np.float64)
-    timeseries = preprocess_timeseries(timeseries, incidences)
-    timeseries = serialize_np(timeseries)
+    start = time.perf_counter()
+    blob = encode_timeseries(timeseries)
 
     ret = pd.Series({
         "case": network_name + "-" + str(index),
         "population": mp.population,
-        "backend": str(model),
+        "backend": str(args.model),
         "initial_infected": mp.initial_infected,
         "network": network,
         "k": k,
         "infectiousness": mp.infectiousness,
-        "i_out": mp.i_out,
-        "i_rec_prop": mp.i_rec_prop,
-        "timeseries": timeseries
+        # the discrete model has no i_out/i_rec_prop
+        "i_out": getattr(mp, 'i_out', None),
+        "i_rec_prop": getattr(mp, 'i_rec_prop', None),
+        "timeseries": blob
     })
 
+    if profile is not None:
+        ret["profile"] = dict(profile, serialize_s=time.perf_counter() - start)
+
     ret.name = ret.case
 
     return ret
 
 
+"""
+Returns the time-series data and parameters from a simulation with randomized parameters. With a
+cache, the raw output of the simulator is looked up there first and stored there after a miss.
+"""
+
+
+def random_simulation(args, graph, X, cache=None):
+    rng = case_rng(args, args.index)
+    mp = random_parameters(args, graph, X, rng)
+    profile = {} if args.profile else None
+
+    start = time.perf_counter()
+    key = cache_key(args, cache, mp) if cache else None
+    timeseries = cache.get(key) if cache else None
+    if timeseries is None:
+        timeseries = model_module(args.model).run_model(mp, graph, rng, profile)
+        reset_network(graph)
+        if cache:
+            cache.put(key, timeseries)
+    simulated = time.perf_counter()
+
+    # prepend the STEP column expected by preprocess_timeseries
+    timeseries = np.asarray(timeseries, np.float64)
+    timeseries = np.column_stack((np.arange(len(timeseries)), timeseries))
+    timeseries = preprocess_timeseries(timeseries, args.incidences)
+
+    if profile is not None:
+        profile.update(simulate_s=simulated - start, preprocess_s=time.perf_counter() - simulated)
+
+    return simulation_series(args, mp, args.index, timeseries, profile)
+
+
+"""
+Returns the time-series data and parameters of `count` simulations with randomized parameters,
+run together as one ensemble on the graph (cases args.index to args.index + count - 1). When
+profiling, every case gets an equal share of the ensemble's simulation and preprocessing time.
+"""
+
+
+def ensemble_simulation(args, graph, X, count):
+    rng = case_rng(args, args.index, count)
+    mps = [random_parameters(args, graph, X, rng) for _ in range(count)]
+
+    start = time.perf_counter()
+    samples = model_module(args.model).run_ensemble(mps, graph, rng)
+    simulated = time.perf_counter()
+    timeseries = preprocess_ensemble(samples, args.incidences)
+
+    profile = None
+    if args.profile:
+        profile = {'simulate_s': (simulated - start) / count,
+                   'preprocess_s': (time.perf_counter() - simulated) / count}
+
+    return [simulation_series(args, mp, args.index + i, timeseries[i], profile) for i, mp in enumerate(mps)]
+
+
+"""
+Returns the (incidences, columns) shape of every preprocessed time-series (STEP + 4 compartments).
+"""
+
+
+def timeseries_shape(args):
+    return (args.incidences, 1 + len(continuous.T_COLUMNS))
+
+
+"""
+Returns the distribution of i_rec_prop (probability that an infected person recovers).
+"""
+
+
+def recovery_distribution():
+    mu = 0.94
+    upper = 1
+    lower = 0
+    sigma = 0.02
+
+    return stats.truncnorm((lower - mu) / sigma,
+                           (upper - mu) / sigma, loc=mu, scale=sigma)
+
+
+"""
+Returns the dataset rows of cases args.index up to args.index + args.batch_size (at most args.max)
+simulated on the graph, single runs going through `cache` if given (ensembles are not cached).
+"""
+
+
+def run_batch(args, graph, X, cache=None):
+    table = []
+    index = args.index
+    batch_size = args.batch_size
+
+    if args.ensemble:
+        table = ensemble_simulation(args, graph, X, min(args.max, index + batch_size) - index)
+    else:
+        for _ in range(index, min(args.max, index + batch_size)):
+            series = random_simulation(args, graph, X, cache)
+            table.append(series)
+            args.index += 1
+
+    return pd.concat(table, axis=1).T
+
+
+"""
+Runs func(*func_args) under cProfile if args.profile_dir is set, dumping the stats to
+profile_dir/name-PID.prof (read them with pstats or snakeviz).
+"""
+
+
+def profiled(args, name, func, *func_args):
+    if not args.profile_dir:
+        return func(*func_args)
+
+    os.makedirs(args.profile_dir, exist_ok=True)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *func_args)
+    finally:
+        profiler.dump_stats(os.path.join(args.profile_dir, '{}-{}.prof'.format(name, os.getpid())))
+
+
+"""
+Worker process of generate(). Takes (graph_type, start, stop, seed) work units from `tasks` until it
+gets None, and puts every unit with its resulting table on `results`, followed by None once it is
+done.
+"""
+
+
+def worker(args, tasks, results):
+    profiled(args, 'worker', work, args, tasks, results)
+    results.put(None)
+
+
+"""
+Runs the work units of worker() until it gets None.
+"""
+
+
+def work(args, tasks, results):
+    X = recovery_distribution()
+    cache = open_cache(args)
+    graphs = {}
+
+    for unit in iter(tasks.get, None):
+        graph_type, start, stop, _ = unit
+        unit_args = argparse.Namespace(**vars(args))
+        unit_args.graph_type = graph_type
+        unit_args.index = start
+        unit_args.max = stop
+
+        if graph_type not in graphs:
+            graphs[graph_type] = setup(unit_args)
+
+        results.put((unit, run_batch(unit_args, graphs[graph_type], X, cache)))
+
+    if cache:
+        print('worker {}: {} cached runs, {} simulated'.format(os.getpid(), cache.hits, cache.misses), file=sys.stderr)
+
+
+"""
+Generates cases args.index up to args.max for every graph with a pool of args.workers processes,
+writing all results to the database from this process through one ResultSink. The batches are
+work units of the table's WorkLedger: units already done under args.seed are skipped, so a
+generation that was stopped picks up where it left off when run again with the same arguments, and
+several generators can work on one table at the same time.
+"""
+
+
+def generate(args):
+    graph_types = [args.graph_type] if args.graph_type else \
+        sorted({fn[:-len(NETWORK_SUFFIX)] if fn.endswith(NETWORK_SUFFIX) else fn
+                for fn in os.listdir(args.network_dir)})
+    units = [(graph_type, index, min(args.max, index + args.batch_size))
+             for index in range(args.index or 0, args.max, args.batch_size)
+             for graph_type in graph_types]
+
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue(maxsize=2 * args.workers)
+
+    # daemonic, so an error here does not leave them waiting for work
+    workers = [multiprocessing.Process(target=worker, args=(args, tasks, results), daemon=True)
+               for _ in range(args.workers)]
+    for p in workers:
+        p.start()
+
+    with ResultSink(args.database_name, args.table_name, timeseries_shape(args)) as sink:
+        ledger = WorkLedger(sink.conn, args.table_name, args.seed, args.lease)
+        ledger.add(units)
+        done = ledger.counts()['done']
+        if done:
+            print('{}: {} of {} units already done'.format(args.table_name, done, len(units)), file=sys.stderr)
+
+        # keep up to two units per worker claimed and queued, renewing the claims while waiting
+        queued = 0
+        renewed = time.time()
+        with tqdm(total=len(units), initial=done) as bar:
+            while True:
+                while queued < 2 * args.workers:
+                    unit = ledger.claim()
+                    if unit is None:
+                        break
+                    tasks.put(unit)
+                    queued += 1
+                if queued == 0:
+                    break
+
+                if time.time() - renewed > args.lease / 4:
+                    ledger.renew()
+                    renewed = time.time()
+                try:
+                    unit, table = results.get(timeout=10)
+                except queue.Empty:
+                    if any(p.exitcode not in (None, 0) for p in workers):
+                        raise RuntimeError('a worker process died')
+                    continue
+
+                sink.write(table, unit)
+                queued -= 1
+                bar.update()
+
+    for _ in workers:
+        tasks.put(None)
+    for _ in workers:
+        results.get()
+    for p in workers:
+        p.join()
+
+
+"""
+Prints the size of every exported file and of the whole export, and warns about any file over the
+GitHub file size limit.
+"""
+
+
+def report_export(files):
+    for path, size in files:
+        print('{}: {:.1f} MB'.format(path, size / 2**20), file=sys.stderr)
+
+    largest = max(size for _, size in files)
+    print('exported {} files, {:.1f} MB in total, largest {:.1f} MB ({:.0%} of the {} MB GitHub limit)'.format(
+        len(files), sum(size for _, size in files) / 2**20, largest / 2**20, largest / GITHUB_FILE_LIMIT,
+        GITHUB_FILE_LIMIT // 2**20), file=sys.stderr)
+    for path, size in files:
+        if size > GITHUB_FILE_LIMIT:
+            print('warning: {} is over the GitHub file size limit'.format(path), file=sys.stderr)
+
+
 """
 Runs if this file is ran as a script (rather than a module).
 """
@@ -152,37 +458,64 @@ def main():
     parser.add_argument('--incidences', type=int)
     parser.add_argument('--batch_size', type=int)
     parser.add_argument('--max', type=int, default=None)
+    parser.add_argument('--ensemble', action='store_true',
+                        help='run the whole batch as one vectorized ensemble')
+    parser.add_argument('--profile', action='store_true',
+                        help='store per-case counters and timings in the TABLE_profile table')
+    parser.add_argument('--profile-dir', type=str, default=None,
+                        help='dump cProfile stats of every worker (or of the single batch) to this directory')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='base seed of all random streams, the same seed reproduces every case '
+                             '(a fresh one is drawn and printed if not given)')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='keep the raw output of every single run in this directory and reuse it when '
+                             'the same graph, parameters and seed come up again')
+    parser.add_argument('--cache-size', type=int, default=4096,
+                        help='size in MB the cache is kept under, evicting the least recently used runs')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='generate cases --index to --max of every graph (or only --graph-type) '
+                             'with a pool of this many processes')
+    parser.add_argument('--lease', type=float, default=1800,
+                        help='seconds after which a work unit claimed by a generator that stopped '
+                             'renewing it is run again')
+
+    parser.add_argument('--export-dir', type=str, default=None,
+                        help='afterwards export the table to synthetic-dataset-MAX.csv.gz and compressed '
+                             'timeseries shards (-part-NNNNN.npz) in this directory')
+    parser.add_argument('--export-npy', action='store_true',
+                        help='export the timeseries to one uncompressed, memory-mappable .npy instead')
+    parser.add_argument('--export-workers', type=int, default=None,
+                        help='threads compressing the exported shards (default: one per CPU)')
 
     args = parser.parse_args()
 
-    tb_name = args.table_name
-    db_name = args.database_name
-    batch_size = args.batch_size
-
-    graph = setup(args)
-
-    mu = 0.94
-    upper = 1
-    lower = 0
-    sigma = 0.02
-
-    X = stats.truncnorm((lower - mu) / sigma,
-                        (upper - mu) / sigma, loc=mu, scale=sigma)
-
-    table = []
-    index = args.index
-
-    for _ in range(index, min(args.max, index + batch_size)):
-        series = random_simulation(args, graph, X)
-        table.append(series)
-        args.index += 1
-
-    table = pd.concat(table, axis=1).T
-
-    conn = sqlite3.connect(db_name)
-    table.to_sql(tb_name, con=conn, index=False, if_exists='append')
-
-    conn.close()
+    # the export is named after the number of cases
+    if args.export_dir and args.max is None:
+        parser.error('--export-dir requires --max')
+
+    if args.seed is None and args.workers:
+        # resume a stopped generation under the seed its work units were made with
+        args.seed = synda_db.ledger_seed(args.database_name, args.table_name)
+        if args.seed is not None:
+            print('resuming with seed: {}'.format(args.seed), file=sys.stderr)
+    # an export-only call generates nothing to seed
+    if args.seed is None and (args.workers or args.graph_type):
+        args.seed = np.random.SeedSequence().entropy
+        print('seed: {}'.format(args.seed), file=sys.stderr)
+
+    if args.workers:
+        generate(args)
+    elif args.graph_type:
+        graph = setup(args)
+        table = profiled(args, 'batch', run_batch, args, graph, recovery_distribution(), open_cache(args))
+
+        with ResultSink(args.database_name, args.table_name, timeseries_shape(args)) as sink:
+            sink.write(table)
+
+    if args.export_dir:
+        csv = Path(args.export_dir) / 'synthetic-dataset-{}.csv.gz'.format(args.max)
+        report_export(synda_db.export(args.database_name, args.table_name, str(csv),
+                                      compress=not args.export_npy, workers=args.export_workers))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import numpy as np
+from scipy.integrate import RK45
+from network import Network
+
+'''
+    Deterministic individual-based mean-field version of continuous_sim: the
+    probabilities s[i] and x[i] that node i is susceptible or infected follow
+
+        ds[i]/dt = -infectiousness * s[i] * sum_j A[i, j] x[j]
+        dx[i]/dt =  infectiousness * s[i] * sum_j A[i, j] x[j] - i_out * x[i]
+
+    on the network's adjacency matrix A, and of the nodes that left the
+    infected compartment a fraction i_rec_prop recovered and the rest died.
+    Every neighbor sum is one sparse matrix product, so a run costs a few
+    hundred of them instead of one event per transition. Mean-field dynamics
+    ignore the correlation between neighbors, and infection rates follow the
+    current infected neighbors (continuous_sim keeps infection times drawn
+    before a neighbor left), so the spread differs from the stochastic
+    models; use it to screen parameters, not as final data.
+'''
+
+T_COLUMNS = ['susceptible', 'c_infected', 'recovered', 'dead']
+P_COLUMNS = ['population', 'backend', 'initial_infected', 'network_name', 'infectiousness', 'i_out', 'i_rec_prop']
+
+class ModelParameters:
+    #number of nodes in the network (10^2, 10^5)
+    population: int
+
+    #expected number of infected nodes at the beginning of the simulation,
+    #spread evenly over all nodes
+    initial_infected: int
+
+    #rate of infection per infected neighbor
+    infectiousness: float
+
+    #rate of leaving the infected compartment
+    i_out: float
+
+    #probability of moving from infected to recovered when leaving it (0-1)
+    i_rec_prop: float
+
+    # time the epidemic is integrated for
+    time: float
+
+    # time between two samples
+    sample_time: float
+
+# Integrates len(mps) replicas on the same network at once with an adaptive
+# Runge-Kutta scheme (scipy's RK45), evaluated every sample_time (time and
+# sample_time of mps[0] are used for all of them). Returns the (m, ticks + 1,
+# 4) expected counts of [susceptible, cumulative infected, recovered, dead] at
+# time 0 and at every tick, samples[i] having the layout of
+# continuous_sim.run_model for mps[i]. rng is not used (the backend is
+# deterministic) and only accepted for the same signature as the stochastic
+# backends; stats gets the number of right-hand side evaluations as steps.
+def run_ensemble(mps, graph: Network, rng: np.random.Generator = None, stats: dict = None, rtol=1e-4):
+    start = time.perf_counter()
+    m, n = len(mps), len(graph)
+    ticks = int(mps[0].time/mps[0].sample_time)
+    infectiousness = np.array([mp.infectiousness for mp in mps])
+    i_out = np.array([mp.i_out for mp in mps])
+    rec_prop = np.array([mp.i_rec_prop for mp in mps])
+    adjacency = graph.adjacency().astype(np.float64)
+
+    # the state is s and x of all replicas as (n, m) matrices, flattened
+    def derivatives(_, y):
+        s, x = y[:n * m].reshape(n, m), y[n * m:].reshape(n, m)
+        infection = infectiousness * s * adjacency.dot(x)
+        return np.concatenate(((-infection).ravel(), (infection - i_out * x).ravel()))
+
+    x = np.tile(np.array([mp.initial_infected for mp in mps], dtype=np.float64) / n, (n, 1))
+    y = np.concatenate(((1 - x).ravel(), x.ravel()))
+    times = np.linspace(0, mps[0].time, ticks + 1)
+
+    # only the totals are kept, every tick the solver steps over is read from
+    # the interpolant of that step
+    susceptible, infected = np.empty((m, ticks + 1)), np.empty((m, ticks + 1))
+    susceptible[:, 0], infected[:, 0] = (1 - x).sum(axis=0), x.sum(axis=0)
+    tick = 1
+
+    loop_start = time.perf_counter()
+    solver = RK45(derivatives, 0, y, mps[0].time, rtol=rtol, atol=1e-8)
+    while tick <= ticks:
+        message = solver.step()
+        if solver.status == 'failed':
+            raise RuntimeError('mean-field integration failed: ' + message)
+        step = solver.dense_output()
+        while tick <= ticks and times[tick] <= solver.t:
+            y = np.clip(step(times[tick]), 0, 1).reshape(2, n, m)
+            susceptible[:, tick], infected[:, tick] = y[0].sum(axis=0), y[1].sum(axis=0)
+            tick += 1
+
+    left = np.maximum(n - susceptible - infected, 0)
+
+    # sub, c_inf, rec, dead
+    samples = np.empty((m, ticks + 1, 4))
+    samples[:, :, 0] = susceptible
+    samples[:, :, 1] = n - susceptible
+    samples[:, :, 2] = rec_prop[:, None] * left
+    samples[:, :, 3] = (1 - rec_prop[:, None]) * left
+
+    if stats is not None:
+        stats.update(steps=solver.nfev, neighbor_scans=solver.nfev * len(graph.indices) * m,
+                     setup_s=loop_start - start, loop_s=time.perf_counter() - loop_start, tail_s=0.0)
+
+    return samples
+
+# One replica of run_ensemble, returns the (ticks + 1, 4) samples. The
+# network's compartments are not touched.
+def run_model(mp: ModelParameters, graph: Network, rng: np.random.Generator = None, stats: dict = None):
+    return run_ensemble([mp], graph, rng, stats)[0]
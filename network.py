@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import struct
+import zlib
+import numpy as np
+import scipy.sparse as sparse
+
+'''
+    Compartments are stored per node as a uint8 code. Both simulators share
+    SUSCEPTIBLE = 0 and INFECTED = 1; the meaning of 2 and 3 is backend
+    specific (see T_COLUMNS in discrete_sim and continuous_sim).
+'''
+
+class Network:
+    # indptr: (n + 1,) offsets into indices, neighbors of node i are
+    # indices[indptr[i]:indptr[i + 1]] (every edge is stored in both directions)
+    indptr: np.ndarray
+
+    # indices: (2 * edges,) neighbor ids
+    indices: np.ndarray
+
+    # comp: (n,) current compartment of every node
+    comp: np.ndarray
+
+    def __init__(self, indptr, indices, comp=None):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=index_dtype(len(self.indptr) - 1))
+        if comp is None:
+            comp = np.zeros(len(self.indptr) - 1, dtype=np.uint8)
+        self.comp = comp
+        self._adjacency = None
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @property
+    def edges(self):
+        return len(self.indices) // 2
+
+    # Sparse (n, n) adjacency matrix sharing indptr/indices with the network.
+    def adjacency(self):
+        if self._adjacency is None:
+            data = np.ones(len(self.indices), dtype=np.int32)
+            self._adjacency = sparse.csr_matrix((data, self.indices, self.indptr), shape=(len(self), len(self)))
+        return self._adjacency
+
+    def degree(self):
+        return np.diff(self.indptr)
+
+    def neighbors(self, node):
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    def num_neighbors(self, node, comp):
+        return int(np.count_nonzero(self.comp[self.neighbors(node)] == comp))
+
+    # Number of neighbors in `comp` for every node at once.
+    def count_neighbors(self, comp):
+        return self.neighbor_counts(self.comp == comp)
+
+    # Number of neighbors flagged in `mask` for every node. mask is either
+    # (n,) or (m, n) for m independent replicas of the network.
+    def neighbor_counts(self, mask):
+        counts = self.adjacency().dot(mask.T.view(np.uint8))
+        return np.ascontiguousarray(counts.T)
+
+    # Adds weights[i] to the counts of every neighbor of cells[i] in a (m, n)
+    # neighbor count matrix, cells being flat indices (replica * n + node).
+    def spread(self, counts, cells, weights):
+        rows, nodes = np.divmod(cells, len(self))
+        delta = sparse.csr_matrix((weights, (rows, nodes)), shape=counts.shape)
+        delta = delta.dot(self.adjacency()).tocoo()
+        counts[delta.row, delta.col] += delta.data
+
+    # Returns the cells (flat indices replica * n + node) next to any of
+    # `cells` in a (m, n) replica matrix, with how many of `cells` each is
+    # next to.
+    def neighbor_cells(self, cells, m):
+        rows, nodes = np.divmod(cells, len(self))
+        marks = sparse.csr_matrix((np.ones(len(cells), np.int32), (rows, nodes)), shape=(m, len(self)))
+        delta = marks.dot(self.adjacency()).tocoo()
+        return delta.row.astype(np.int64) * len(self) + delta.col, delta.data
+
+    def set_comp(self, node, comp):
+        self.comp[node] = comp
+
+    def reset(self):
+        self.comp[:] = 0
+
+    # Builds the symmetric CSR arrays from an adjacency list in which every
+    # edge is listed once (the format written by generate_graphs).
+    @classmethod
+    def from_adj_list(cls, adj_list: list):
+        n = len(adj_list)
+        dtype = index_dtype(n)
+        lengths = np.fromiter((len(a) for a in adj_list), dtype=np.int64, count=n)
+
+        src = np.repeat(np.arange(n, dtype=dtype), lengths)
+        dst = np.fromiter((j for a in adj_list for j in a), dtype=dtype, count=int(lengths.sum()))
+
+        return cls.from_edges(n, src, dst)
+
+    @classmethod
+    def from_edges(cls, n, src, dst):
+        dtype = index_dtype(n)
+        rows = np.concatenate((src, dst)).astype(dtype, copy=False)
+        cols = np.concatenate((dst, src)).astype(dtype, copy=False)
+
+        order = np.argsort(rows, kind='stable')
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+
+        return cls(indptr, cols[order])
+
+
+class Replicas:
+    """
+    m independent copies of the compartments of one network, kept as a (m, n)
+    uint8 matrix together with the infected-neighbor count of every cell, the
+    flat indices (replica * n + node) of the infected cells and the (m, 4)
+    compartment totals.
+    """
+
+    def __init__(self, graph: Network, initial_infected, rng: np.random.Generator):
+        m, n = len(initial_infected), len(graph)
+        self.graph = graph
+        self.comp = np.zeros((m, n), dtype=np.uint8)
+        for r, inf in enumerate(initial_infected):
+            self.comp[r, rng.choice(n, inf, replace=False)] = 1
+        self.inf_neighbors = graph.neighbor_counts(self.comp == 1)
+        self.infected = np.flatnonzero(self.comp == 1)
+        self.results = count_compartments(self.comp)
+
+    def __len__(self):
+        return self.comp.shape[0]
+
+    # Flat indices of the susceptible cells with at least one infected neighbor.
+    def exposed(self):
+        return np.flatnonzero((self.inf_neighbors != 0) & (self.comp == 0))
+
+    # Moves the susceptible cells `infect` to INFECTED and the infected cells
+    # selected by the boolean mask `leave` (over self.infected) to `leave_comp`.
+    def update(self, infect, leave, leave_comp):
+        m, n = self.comp.shape
+        flat = self.comp.reshape(-1)
+        left = self.infected[leave]
+
+        flat[infect] = 1
+        flat[left] = leave_comp
+        self.infected = np.concatenate((self.infected[~leave], infect))
+
+        infect_rows, left_rows = infect // n, left // n
+        self.results[:, 0] -= np.bincount(infect_rows, minlength=m)
+        self.results[:, 1] += np.bincount(infect_rows, minlength=m) - np.bincount(left_rows, minlength=m)
+        np.add.at(self.results, (left_rows, leave_comp), 1)
+
+        self.graph.spread(self.inf_neighbors, np.concatenate((infect, left)),
+                          np.concatenate((np.ones(len(infect), np.int32), np.full(len(left), -1, np.int32))))
+
+# Number of nodes in every compartment for each replica of a (m, n)
+# compartment matrix, as a (m, 4) array.
+def count_compartments(comp):
+    offsets = 4 * np.arange(comp.shape[0])[:, None]
+    return np.bincount((comp + offsets).ravel(), minlength=4 * comp.shape[0]).reshape(-1, 4)
+
+def index_dtype(n):
+    return np.int32 if n < np.iinfo(np.int32).max else np.int64
+
+# Generator of the random stream named by `keys` (ints or strings, e.g. a
+# graph name and a case index) under the base `seed`. The same seed and keys
+# always give the same stream, different keys give independent ones, no
+# matter which process draws from them. A seed of None draws fresh entropy.
+def random_stream(seed, *keys):
+    spawn_key = tuple(zlib.crc32(k.encode()) if isinstance(k, str) else int(k) for k in keys)
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=spawn_key))
+
+class RandomBuffer:
+    """
+    Numbers drawn in blocks by a Generator method (e.g. rng.random or
+    rng.standard_exponential) and handed out one per call, for loops that
+    need a single number per iteration (a scalar Generator call costs far
+    more than a list lookup).
+    """
+
+    def __init__(self, draw, block=4096):
+        self.draw = draw
+        self.block = block
+        self.values = []
+        self.pos = 0
+
+    def __call__(self):
+        if self.pos == len(self.values):
+            self.values = self.draw(self.block).tolist()
+            self.pos = 0
+        self.pos += 1
+        return self.values[self.pos - 1]
+
+'''
+    Binary network file: a 64 byte header followed by the CSR arrays, so a
+    network can be memory-mapped instead of unpickled and rebuilt. Read-only
+    maps of the same file share their pages between processes.
+
+    header: magic, graph type (e.g. b'BA'), k, n, len(indices), index itemsize
+    indptr: (n + 1,) little-endian int64
+    indices: (len(indices),) little-endian int32 (int64 for n >= 2^31 - 1)
+'''
+NETWORK_MAGIC = b'CSRNET01'
+NETWORK_HEADER = struct.Struct('<8s4sIQQI')
+NETWORK_HEADER_SIZE = 64
+
+def save_network(graph: Network, path, graph_type='', k=0):
+    n, nnz = len(graph), len(graph.indices)
+    dtype = np.dtype(index_dtype(n)).newbyteorder('<')
+    header = NETWORK_HEADER.pack(NETWORK_MAGIC, graph_type.encode('ascii'), k, n, nnz, dtype.itemsize)
+
+    # write next to the target and rename, so concurrent readers never see
+    # a partial file
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(header.ljust(NETWORK_HEADER_SIZE, b'\0'))
+        f.write(np.ascontiguousarray(graph.indptr, dtype='<i8').tobytes())
+        f.write(np.ascontiguousarray(graph.indices, dtype=dtype).tobytes())
+    os.replace(tmp, path)
+
+# Returns the header of a network file as a dict (graph, k, n, nnz, itemsize).
+def read_network_header(path):
+    with open(path, 'rb') as f:
+        magic, graph_type, k, n, nnz, itemsize = NETWORK_HEADER.unpack(f.read(NETWORK_HEADER.size))
+    if magic != NETWORK_MAGIC:
+        raise ValueError('{} is not a network file'.format(path))
+    return {'graph': graph_type.rstrip(b'\0').decode('ascii'), 'k': k, 'n': n, 'nnz': nnz, 'itemsize': itemsize}
+
+def load_network(path):
+    header = read_network_header(path)
+    n, nnz = header['n'], header['nnz']
+    indptr = np.memmap(path, dtype='<i8', mode='r', offset=NETWORK_HEADER_SIZE, shape=(n + 1,))
+    indices = np.memmap(path, dtype='<i{}'.format(header['itemsize']), mode='r',
+                        offset=NETWORK_HEADER_SIZE + 8 * (n + 1), shape=(nnz,))
+    return Network(indptr, indices)
@@ -8,51 +8,23 @@ output_dir="$1"
 N="$2"
 batch_size="$3"
 incidences="$4"
+# a fixed seed makes reruns reproduce (and reuse the cached runs of) the same cases
+seed="${5:-0}"
+cache_dir="${6:-datasets/simulations/}"
 
 database_name="datasets/synda.db"
 table_name="DATASET_${N}"
 
-# Create proper table for insertion
-sqlite3 "$database_name" <<EOF
-DROP TABLE IF EXISTS ${table_name};
+# generate_synda.py creates the table and its work ledger, and when run again (e.g. after being
+# stopped) only runs the work units that are not done yet. Delete the database (make clean) to
+# start over.
 
-CREATE TABLE ${table_name} (
-    [case] TEXT PRIMARY KEY, 
-    population INTEGER,
-    backend TEXT,
-    initial_infected INTEGER,
-    network TEXT,
-    k INTEGER,
-    infectiousness REAL,
-    i_out REAL,
-    i_rec_prop REAL,
-    timeseries TEXT
-);
-EOF
-
-parallel --bar -j"$virtual_cores" \
-	python generate_synda.py --model CONTINUOUS \
-	--incidences "$incidences" --index {1} --graph-type {2} \
+python generate_synda.py --model CONTINUOUS --workers "$virtual_cores" \
+	--network-dir "$networks_dir" --incidences "$incidences" --index 0 \
 	--batch_size "$batch_size" --max "$N" \
-	--database-name "$database_name" --table-name "$table_name" ::: \
-	$(seq 0 "$batch_size" "$N") ::: \
-	$(ls -1q "$networks_dir")
-
-# Output whole thing to csv
-(
-sqlite3 -header -csv "$database_name"<<EOF
-SELECT [case],
-	population,
-	initial_infected,
-	network,
-	k,
-	infectiousness,
-	i_out,
-	i_rec_prop,
-	timeseries 
-FROM DATASET_100
-EOF
-) > "$output_dir"synthetic-dataset-${N}.csv
+	--database-name "$database_name" --table-name "$table_name" \
+	--seed "$seed" --cache-dir "$cache_dir"
 
-# gzip to max compression (hopefully to fit in github file)
-gzip -9 "$output_dir"synthetic-dataset-${N}.csv
\ No newline at end of file
+# Export the table to a gzip csv of the parameters and compressed .npz shards of the timeseries
+python generate_synda.py --database-name "$database_name" --table-name "$table_name" \
+	--max "$N" --export-dir "$output_dir"
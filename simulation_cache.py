@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import numpy as np
+
+'''
+    On-disk cache of raw simulator outputs (what run_model returns, before
+    preprocess_timeseries), so regenerating a dataset at another resolution
+    or after a crash does not simulate the same runs again.
+
+    An entry is addressed by the sha256 of everything that determines the
+    run: the digest of the network file, the backend, every field of its
+    ModelParameters and the key of its random stream. It is stored as
+    directory/ab/abcd....npy; a hit bumps the file's mtime, and once the
+    entries grow past max_bytes the least recently used ones are deleted
+    down to LOW_WATER of it. Several processes can share a directory (every
+    file is written under a temporary name and renamed), each of them then
+    only counting its own writes towards the bound between two scans.
+'''
+
+# fraction of max_bytes left after an eviction, so not every write rescans
+LOW_WATER = 0.9
+
+class SimulationCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._digests = {}
+        os.makedirs(self.directory, exist_ok=True)
+        self.size = sum(size for _, _, size in self._entries())
+
+    # Hex key of a run from the digest of its network file (file_digest),
+    # backend name, ModelParameters and random stream key (a tuple of ints
+    # and strings, e.g. seed, graph name and case index).
+    def key(self, graph_digest, backend, mp, stream):
+        record = {'graph': graph_digest, 'backend': str(backend), 'parameters': vars(mp), 'stream': list(stream)}
+        blob = json.dumps(record, sort_keys=True, default=_json_value)
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    # sha256 of a file's contents, remembered as long as its size and mtime
+    # do not change.
+    def file_digest(self, path):
+        st = os.stat(path)
+        memo = (str(path), st.st_size, st.st_mtime_ns)
+        if memo not in self._digests:
+            h = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+            self._digests[memo] = h.hexdigest()
+        return self._digests[memo]
+
+    # Cached output of the run `key`, or None.
+    def get(self, key):
+        path = self._path(key)
+        try:
+            samples = np.load(path, allow_pickle=False)
+            os.utime(path)
+        except (OSError, ValueError):
+            # missing, evicted by another process meanwhile or unreadable
+            self.misses += 1
+            return None
+        self.hits += 1
+        return samples
+
+    def put(self, key, samples):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, np.asarray(samples), allow_pickle=False)
+        self.size += os.path.getsize(tmp)
+        os.replace(tmp, path)
+
+        if self.size > self.max_bytes:
+            self.evict()
+
+    # Deletes the least recently used entries until they take at most
+    # LOW_WATER * max_bytes.
+    def evict(self):
+        entries = sorted(self._entries())
+        self.size = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if self.size <= LOW_WATER * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.npy')
+
+    # (mtime, path, size) of every entry.
+    def _entries(self):
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith('.npy'):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield st.st_mtime_ns, entry.path, st.st_size
+
+# NumPy scalars (e.g. parameters drawn by a Generator) as Python numbers.
+def _json_value(v):
+    if isinstance(v, np.generic):
+        return v.item()
+    raise TypeError('cannot key a simulation on {!r}'.format(v))
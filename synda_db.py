@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import gzip
+import os
+from concurrent.futures import ThreadPoolExecutor
+import socket
+import sqlite3
+import sys
+import time
+import numpy as np
+import pandas as pd
+from datasets import PARAMETER_COLUMNS, TIMESERIES_DTYPE, stack_timeseries, timeseries_path, \
+    timeseries_shard_path, timeseries_shards
+
+COLUMNS = ['case', 'population', 'backend', 'initial_infected', 'network', 'k',
+           'infectiousness', 'i_out', 'i_rec_prop', 'timeseries']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS {table} (
+    [case] TEXT PRIMARY KEY,
+    population INTEGER,
+    backend TEXT,
+    initial_infected INTEGER,
+    network TEXT,
+    k INTEGER,
+    infectiousness REAL,
+    i_out REAL,
+    i_rec_prop REAL,
+    timeseries BLOB
+)
+'''
+
+# Shape and dtype of the timeseries blobs of every dataset table.
+SHAPES_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS TIMESERIES_SHAPES (
+    [table] TEXT PRIMARY KEY,
+    incidences INTEGER,
+    columns INTEGER,
+    dtype TEXT
+)
+'''
+
+# Counters of generate_synda --profile, one row per case in the {table}_profile table next to the
+# dataset table (join on case). Counters a backend does not have are NULL.
+PROFILE_COLUMNS = ['events', 'stale', 'queue_max', 'steps', 'neighbor_scans',
+                   'setup_s', 'loop_s', 'tail_s', 'simulate_s', 'preprocess_s', 'serialize_s', 'write_s']
+
+PROFILE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS {table}_profile (
+    [case] TEXT PRIMARY KEY,
+    events INTEGER,
+    stale INTEGER,
+    queue_max INTEGER,
+    steps INTEGER,
+    neighbor_scans INTEGER,
+    setup_s REAL,
+    loop_s REAL,
+    tail_s REAL,
+    simulate_s REAL,
+    preprocess_s REAL,
+    serialize_s REAL,
+    write_s REAL
+)
+'''
+
+# Work units of generate_synda --workers, cases [start, stop) of one graph under one seed, in the
+# {table}_units table next to the dataset table. state is pending, running (claimed by owner, a
+# host:pid, which last renewed its claim at `updated`) or done (its rows are in the table).
+LEDGER_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS {table}_units (
+    graph TEXT,
+    start INTEGER,
+    stop INTEGER,
+    seed TEXT,
+    state TEXT,
+    owner TEXT,
+    updated REAL,
+    PRIMARY KEY (graph, start, stop, seed)
+)
+'''
+
+
+"""
+Opens the dataset database with WAL journaling so readers never block the writer.
+"""
+
+
+def connect(database_name, timeout=60):
+    conn = sqlite3.connect(database_name, timeout=timeout)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-65536')
+    return conn
+
+
+"""
+Returns the (incidences, columns) shape of the timeseries blobs in a table.
+"""
+
+
+def timeseries_shape(conn, table_name):
+    row = conn.execute('SELECT incidences, columns FROM TIMESERIES_SHAPES WHERE [table] = ?',
+                       (table_name,)).fetchone()
+    if row is None:
+        raise KeyError('no timeseries shape recorded for table ' + table_name)
+    return tuple(row)
+
+
+"""
+Returns a row value sqlite3 can bind (NumPy scalars are converted to Python ones).
+"""
+
+
+def _sql_value(v):
+    return v.item() if isinstance(v, np.generic) else v
+
+
+"""
+Collects dataset rows and inserts them into one table in batches of `batch_rows` (or whatever is
+queued once the oldest row has waited `max_delay` seconds), each batch in a single transaction.
+Timeseries must already be encoded by datasets.encode_timeseries, all with the given (incidences,
+columns) shape, which must be the one recorded for the table if it already exists (a ValueError is
+raised otherwise). A case written again replaces its row. A batch that fails because the database
+is locked is retried with exponential backoff, and stays queued until it goes through. If the rows
+carry a `profile` column (dicts of PROFILE_COLUMNS counters), the counters go to the
+{table}_profile table, with write_s set to the row's share of the time its batch took to insert.
+Work units written with their rows are marked done in the same transaction (see WorkLedger).
+"""
+
+
+class ResultSink:
+    def __init__(self, database_name, table_name, shape, batch_rows=1024, retries=10, max_delay=60):
+        self.conn = connect(database_name)
+        self.table_name = table_name
+        self.batch_rows = batch_rows
+        self.retries = retries
+        self.max_delay = max_delay
+
+        self.conn.execute(SCHEMA.format(table=table_name))
+        self.conn.execute(SHAPES_SCHEMA)
+        recorded = self.conn.execute('SELECT incidences, columns, dtype FROM TIMESERIES_SHAPES WHERE [table] = ?',
+                                     (table_name,)).fetchone()
+        expected = (shape[0], shape[1], TIMESERIES_DTYPE.str)
+        if recorded is None:
+            self.conn.execute('INSERT INTO TIMESERIES_SHAPES VALUES (?, ?, ?, ?)', (table_name,) + expected)
+        elif tuple(recorded) != expected:
+            self.conn.close()
+            raise ValueError('table {} holds {}x{} {} timeseries, cannot add {}x{} {} ones'.format(
+                table_name, *recorded, *expected))
+        self.conn.commit()
+
+        self.insert = 'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+            table_name, ', '.join('[{}]'.format(c) for c in COLUMNS), ', '.join('?' * len(COLUMNS)))
+        self.profile_insert = 'INSERT OR REPLACE INTO {}_profile ([case], {}) VALUES ({})'.format(
+            table_name, ', '.join(PROFILE_COLUMNS), ', '.join('?' * (len(PROFILE_COLUMNS) + 1)))
+        self.unit_done = "UPDATE {}_units SET state = 'done', updated = ? " \
+                         "WHERE graph = ? AND start = ? AND stop = ? AND seed = ?".format(table_name)
+
+        self.pending = []
+        self.pending_profiles = []
+        self.pending_units = []
+        self.pending_since = None
+        self.profile_totals = {}
+        self.rows = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    """
+    Queues the rows of a DataFrame with the dataset columns. `unit`, a WorkLedger unit (graph, start,
+    stop, seed) whose rows these are, is marked done once they are inserted.
+    """
+
+    def write(self, table, unit=None):
+        if not self.pending:
+            self.pending_since = time.perf_counter()
+        for row in table[COLUMNS].itertuples(index=False, name=None):
+            self.pending.append(tuple(map(_sql_value, row)))
+        if 'profile' in table.columns:
+            self.pending_profiles.extend(p for p in zip(table['case'], table['profile']) if p[1] is not None)
+        if unit is not None:
+            self.pending_units.append(unit)
+        if len(self.pending) >= self.batch_rows or time.perf_counter() - self.pending_since >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        start = time.perf_counter()
+        now = time.time()
+        self._execute((self.insert, self.pending), (self.unit_done, [(now,) + u for u in self.pending_units]))
+        seconds = time.perf_counter() - start
+        self.seconds += seconds
+
+        self.rows += len(self.pending)
+        self.bytes += sum(len(v) if isinstance(v, (str, bytes)) else 8 for row in self.pending for v in row)
+
+        if self.pending_profiles:
+            self.conn.execute(PROFILE_SCHEMA.format(table=self.table_name))
+            rows = []
+            for case, profile in self.pending_profiles:
+                profile = dict(profile, write_s=seconds / len(self.pending))
+                rows.append((case,) + tuple(_sql_value(profile.get(c)) for c in PROFILE_COLUMNS))
+                for c, v in profile.items():
+                    total = self.profile_totals.get(c, 0)
+                    self.profile_totals[c] = max(total, v) if c == 'queue_max' else total + v
+            self.profile_totals['runs'] = self.profile_totals.get('runs', 0) + len(rows)
+            self._execute((self.profile_insert, rows))
+
+        self.pending = []
+        self.pending_profiles = []
+        self.pending_units = []
+
+    # Runs executemany for every (sql, rows) pair in one transaction, retrying while the database is
+    # locked.
+    def _execute(self, *statements):
+        for attempt in range(self.retries + 1):
+            try:
+                with self.conn:
+                    for sql, rows in statements:
+                        if rows:
+                            self.conn.executemany(sql, rows)
+                return
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) or attempt == self.retries:
+                    raise
+                time.sleep(0.1 * 2 ** attempt)
+
+    """
+    Returns the rows and bytes inserted so far and the rate at which they were written.
+    """
+
+    def throughput(self):
+        seconds = max(self.seconds, 1e-9)
+        return {
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'seconds': self.seconds,
+            'rows_per_s': self.rows / seconds,
+            'bytes_per_s': self.bytes / seconds,
+        }
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+        t = self.throughput()
+        print('{}: wrote {} rows ({:.1f} MB) in {:.2f}s, {:.0f} rows/s, {:.2f} MB/s'.format(
+            self.table_name, t['rows'], t['bytes'] / 1e6, t['seconds'], t['rows_per_s'], t['bytes_per_s'] / 1e6),
+            file=sys.stderr)
+
+        if self.profile_totals:
+            totals = self.profile_totals
+            print('{}: profiled {} runs, '.format(self.table_name, totals.pop('runs')) + ', '.join(
+                '{} {:.4g}'.format(c, totals[c]) for c in PROFILE_COLUMNS if c in totals), file=sys.stderr)
+
+
+"""
+Work ledger of a dataset table under one seed, on the connection of its ResultSink, so a generation
+that is stopped can be restarted without redoing or losing cases. Units are added once as pending
+and claimed one at a time (atomically, so several generators can share the table); a ledger only
+claims and counts the units added through it, so units left pending by a run with other ranges
+(e.g. another --max or --batch_size) are not picked up. Rows written through
+ResultSink.write(rows, unit) mark their unit done together with their insert. A claim not
+renewed for `lease` seconds, or held by a process of this host that no longer exists, is given to
+the next claimer.
+"""
+
+
+class WorkLedger:
+    def __init__(self, conn, table_name, seed, lease=1800):
+        self.conn = conn
+        self.table_name = table_name
+        self.seed = str(seed)
+        self.lease = lease
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+        with self.conn:
+            self.conn.execute(LEDGER_SCHEMA.format(table=table_name))
+            # the units added through this ledger, private to its connection
+            self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS [{}_added] '
+                              '(graph TEXT, start INTEGER, stop INTEGER, PRIMARY KEY (graph, start, stop))'.format(
+                                  table_name))
+        self.release_dead()
+
+    """
+    Adds the (graph, start, stop) units not in the ledger yet as pending.
+    """
+
+    def add(self, units):
+        units = [tuple(unit) for unit in units]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO {}_units VALUES (?, ?, ?, ?, 'pending', NULL, NULL)".format(self.table_name),
+                [unit + (self.seed,) for unit in units])
+            self.conn.executemany('INSERT OR IGNORE INTO [{}_added] VALUES (?, ?, ?)'.format(self.table_name), units)
+
+    """
+    Returns the ledger key (graph, start, stop, seed) of the next unit to run, now running under this
+    process, or None once every unit is done or claimed.
+    """
+
+    def claim(self):
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.conn.execute(
+                "SELECT graph, start, stop FROM {0}_units JOIN [{0}_added] USING (graph, start, stop) "
+                "WHERE seed = ? AND (state = 'pending' OR (state = 'running' AND updated < ?)) "
+                "ORDER BY start, graph LIMIT 1".format(self.table_name), (self.seed, now - self.lease)).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    "UPDATE {}_units SET state = 'running', owner = ?, updated = ? "
+                    "WHERE graph = ? AND start = ? AND stop = ? AND seed = ?".format(self.table_name),
+                    (self.owner, now) + row + (self.seed,))
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        return None if row is None else row + (self.seed,)
+
+    """
+    Renews the claims of this process.
+    """
+
+    def renew(self):
+        with self.conn:
+            self.conn.execute("UPDATE {}_units SET updated = ? WHERE owner = ? AND state = 'running'".format(
+                self.table_name), (time.time(), self.owner))
+
+    """
+    Puts the units claimed by processes of this host that are gone (e.g. a generator killed before
+    it wrote their rows) back to pending.
+    """
+
+    def release_dead(self):
+        host = socket.gethostname()
+        owners = [o for (o,) in self.conn.execute(
+            "SELECT DISTINCT owner FROM {}_units WHERE state = 'running'".format(self.table_name))]
+        dead = [o for o in owners if o.rpartition(':')[0] == host and not _alive(int(o.rpartition(':')[2]))]
+        with self.conn:
+            self.conn.executemany("UPDATE {}_units SET state = 'pending', owner = NULL "
+                                  "WHERE owner = ? AND state = 'running'".format(self.table_name),
+                                  [(o,) for o in dead])
+
+    """
+    Returns the number of units added through this ledger in each state (pending, running, done).
+    """
+
+    def counts(self):
+        counts = dict.fromkeys(['pending', 'running', 'done'], 0)
+        counts.update(self.conn.execute(
+            'SELECT state, COUNT(*) FROM {0}_units JOIN [{0}_added] USING (graph, start, stop) '
+            'WHERE seed = ? GROUP BY state'.format(self.table_name), (self.seed,)))
+        return counts
+
+
+"""
+Returns the seed of the work ledger of a table, or None if it has none (or units of several seeds).
+"""
+
+
+def ledger_seed(database_name, table_name):
+    if not os.path.exists(database_name):
+        return None
+    conn = connect(database_name)
+    try:
+        seeds = conn.execute('SELECT DISTINCT seed FROM {}_units'.format(table_name)).fetchall()
+    except sqlite3.OperationalError:
+        seeds = []
+    conn.close()
+    return int(seeds[0][0]) if len(seeds) == 1 else None
+
+
+# Whether a process of this host is still running.
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+"""
+Exports a dataset table: the parameters of every case go to a gzip CSV, and their timeseries, in the
+same order, either to compressed .npz shards next to it (datasets.timeseries_shard_path) of at most
+`shard_bytes` uncompressed each, compressed by `workers` threads while the next rows are read, or
+with compress=False to one (n_cases, incidences, columns) .npy file next to it
+(datasets.timeseries_path) that loads memory-mapped. Rows are read `chunk_rows` at a time. Returns
+the path and size in bytes of every written file.
+"""
+
+
+def export(database_name, table_name, csv, chunk_rows=4096, compress=True, shard_bytes=64 * 2**20, workers=None):
+    conn = connect(database_name)
+    shape = timeseries_shape(conn, table_name)
+    n = conn.execute('SELECT COUNT(*) FROM {}'.format(table_name)).fetchone()[0]
+
+    # the timeseries of an earlier export of the same CSV would be loaded instead of (or after) these
+    for path in timeseries_shards(csv) + [timeseries_path(csv)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    if compress:
+        shard_rows = max(1, shard_bytes // (TIMESERIES_DTYPE.itemsize * shape[0] * shape[1]))
+        X = _ShardWriter(csv, shard_rows, shape, workers)
+    else:
+        X = np.lib.format.open_memmap(timeseries_path(csv), mode='w+', dtype=TIMESERIES_DTYPE, shape=(n,) + shape)
+    cursor = conn.execute('SELECT {}, timeseries FROM {} ORDER BY rowid'.format(
+        ', '.join('[{}]'.format(c) for c in PARAMETER_COLUMNS), table_name))
+
+    row = 0
+    with gzip.open(csv, 'wt', compresslevel=9) as f:
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+
+            meta = pd.DataFrame([r[:-1] for r in rows], columns=PARAMETER_COLUMNS)
+            meta.to_csv(f, header=row == 0, index=False)
+            X[row:row + len(rows)] = stack_timeseries((r[-1] for r in rows), shape)
+            row += len(rows)
+
+    X.flush()
+    conn.close()
+
+    files = [csv] + (X.paths if compress else [timeseries_path(csv)])
+    return [(path, os.path.getsize(path)) for path in files]
+
+
+# Writes consecutive rows of timeseries (assigned as slices, like the .npy memmap export writes to)
+# into .npz shards of shard_rows rows, compressing full shards in a thread pool (zlib releases the
+# GIL) with at most `workers` + 1 of them waiting.
+class _ShardWriter:
+    def __init__(self, csv, shard_rows, shape, workers=None):
+        self.csv = csv
+        self.shard_rows = shard_rows
+        self.workers = workers or os.cpu_count()
+        self.pool = ThreadPoolExecutor(self.workers)
+        self.buffer = np.empty((shard_rows,) + tuple(shape), dtype=TIMESERIES_DTYPE)
+        self.fill = 0
+        self.futures = []
+        self.paths = []
+
+    def __setitem__(self, rows, x):
+        while len(x):
+            take = min(len(x), self.shard_rows - self.fill)
+            self.buffer[self.fill:self.fill + take] = x[:take]
+            self.fill += take
+            x = x[take:]
+            if self.fill == self.shard_rows:
+                self._submit()
+
+    def flush(self):
+        if self.fill or not self.paths:
+            self._submit()
+        for future in self.futures:
+            future.result()
+        self.pool.shutdown()
+
+    def _submit(self):
+        while len(self.futures) > self.workers:
+            self.futures.pop(0).result()
+        path = timeseries_shard_path(self.csv, len(self.paths))
+        self.futures.append(self.pool.submit(_save_shard, path, self.buffer[:self.fill].copy()))
+        self.paths.append(path)
+        self.fill = 0
+
+
+def _save_shard(path, x):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.savez_compressed(f, timeseries=x)
+    os.replace(tmp, path)